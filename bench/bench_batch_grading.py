@@ -0,0 +1,109 @@
+"""LLM requests and throughput of the worker with and without batch grading.
+
+Drains a queue of distinct answers through worker.handler against
+FakePostgrest with a stubbed LLM whose latency grows with the number of
+answers in the prompt (base + per-answer cost). Optionally a share of the
+batch replies is malformed, to exercise the one-by-one fallback. Prints
+LLM requests per answer and answers per second for each GRADING_BATCH_SIZE.
+
+    python bench/bench_batch_grading.py --items 80 --sizes 1,4,8 --malformed 0.1
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('SUPABASE_URL', 'http://supabase.local')
+os.environ.setdefault('SUPABASE_KEY', 'bench')
+os.environ.setdefault('TELEGRAM_API_URL', 'http://telegram.local')
+# The fake Telegram has no global limit; the per-chat one still applies.
+os.environ.setdefault('TELEGRAM_GLOBAL_RPS', '0')
+# Every answer must reach the (stubbed) LLM: no rate limit, no grade reuse.
+os.environ.setdefault('MISTRAL_RPS', '0')
+os.environ.setdefault('GRADING_CACHE_ENABLED', '0')
+
+import worker  # noqa: E402
+from bench.fakes import FakePostgrest, FakeTelegram, install_postgrest, install_telegram, seed_catalog  # noqa: E402
+
+
+class FakeContext:
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+class StubLLM:
+    def __init__(self, base: float, per_item: float, malformed: float):
+        self.base = base
+        self.per_item = per_item
+        self.malformed = malformed
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _call(self, answers: int):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.base + self.per_item * answers)
+
+    def single(self, *args):
+        self._call(1)
+        return '{"score": 1, "max_score": 2, "comment": "Хорошо."}'
+
+    def batch(self, entries):
+        self._call(len(entries))
+        if random.random() < self.malformed:
+            return "Извините, не могу вернуть JSON."
+        return json.dumps([{'id': n, 'score': 1, 'comment': 'Хорошо.'} for n in range(len(entries))],
+                          ensure_ascii=False)
+
+
+def run(items: int, batch_size: int, llm: StubLLM):
+    db = install_postgrest(FakePostgrest(rtt=0.002))
+    install_telegram(FakeTelegram())
+    seed_catalog(db, 10)
+    for i in range(items):
+        db.insert('processing_queue', {'chat_id': 1000 + i, 'user_id': 1000 + i, 'task_id': 1 + i % 10,
+                                       'user_answer_text': f"ответ {i}", 'status': 'pending',
+                                       'created_at': f"{i:08d}"})
+    worker.GRADING_BATCH_SIZE = batch_size
+    worker.evaluate_answer = llm.single
+    worker.evaluate_answers_batch = llm.batch
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # worker logs
+        while db.select('processing_queue', status='in.(pending,processing)'):
+            worker.handler({}, FakeContext())
+    elapsed = time.perf_counter() - started
+
+    attempts = db.tables['attempts']
+    scored = sum(1 for a in attempts if a['score'] == 1)
+    print(f"batch={batch_size:<3} llm_calls/answer={llm.calls / items:.2f} "
+          f"answers/s={items / elapsed:6.1f} graded={len(attempts)}/{items} scored={scored}")
+    return len(attempts) == items and scored == items
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=80)
+    parser.add_argument('--sizes', default='1,4,8')
+    parser.add_argument('--base-ms', type=float, default=50.0, help='fixed latency of one LLM request')
+    parser.add_argument('--item-ms', type=float, default=5.0, help='extra latency per answer in the prompt')
+    parser.add_argument('--malformed', type=float, default=0.0, help='share of malformed batch replies')
+    args = parser.parse_args()
+
+    random.seed(1)
+    ok = True
+    for size in (int(s) for s in re.split(r'[,\s]+', args.sizes.strip())):
+        llm = StubLLM(args.base_ms / 1000, args.item_ms / 1000, args.malformed)
+        ok &= run(args.items, size, llm)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""Cold start of the function containers: import time and the first update.
+
+Every measurement runs in a fresh interpreter, like a new container:
+`python -X importtime -c "import <module>"` gives the cumulative import time
+of handler and worker (best of --runs), and a separate process imports
+handler, mounts the in-process fakes and times the first handler.handler
+call (a /start of a new user). Exits 1 when a number is over its limit, so
+it can run in CI next to the other benchmarks:
+
+    python bench/bench_cold_start.py --max-import-ms 150 --max-first-update-ms 300
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ENV = {
+    'SUPABASE_URL': 'http://supabase.local',
+    'SUPABASE_KEY': 'bench',
+    'TELEGRAM_API_URL': 'http://telegram.local',
+    'MISTRAL_API_KEY': 'bench',
+}
+
+FIRST_UPDATE = """
+import json, time
+started = time.perf_counter()
+import handler
+imported = time.perf_counter()
+# The connection pool (and requests with it) is created by the first update in
+# production; here the fakes need it first, so it is built inside the timing.
+import http_client
+http_client.get_session()
+pooled = time.perf_counter()
+from bench.fakes import FakePostgrest, FakeTelegram, install_postgrest, install_telegram, make_update, seed_catalog
+db = install_postgrest(FakePostgrest())
+install_telegram(FakeTelegram())
+seed_catalog(db, 20)
+setup = time.perf_counter() - pooled
+response = handler.handler({'body': json.dumps(make_update(42, '/start', 1))}, None)
+assert response['statusCode'] == 200, response
+print('result', json.dumps({'import_ms': (imported - started) * 1000,
+                            'total_ms': (time.perf_counter() - started - setup) * 1000}))
+"""
+
+
+def python(args, capture='stdout'):
+    env = dict(os.environ, **ENV, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='1')
+    result = subprocess.run([sys.executable, *args], cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else 'failed')
+    return getattr(result, capture)
+
+
+def import_profile(module: str):
+    """(total ms, [(ms, package)] of its slowest direct imports) from -X importtime."""
+    total, top = 0.0, []
+    for line in python(['-X', 'importtime', '-c', f"import {module}"], capture='stderr').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        try:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            cumulative_ms = int(cumulative) / 1000
+        except ValueError:  # header line
+            continue
+        # Nesting is shown by indentation; children are printed before their parent.
+        if name.strip() == module:
+            total = cumulative_ms
+            break
+        if not name.startswith('  '):  # another top-level import (site etc.)
+            top = []
+            continue
+        if name.startswith('   ') and not name.startswith('    '):
+            top.append((cumulative_ms, name.strip()))
+    return total, sorted(top, reverse=True)[:3]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-import-ms', type=float, default=150.0)
+    parser.add_argument('--max-first-update-ms', type=float, default=300.0)
+    args = parser.parse_args()
+
+    failed = False
+    for module in ('handler', 'worker'):
+        profiles = [import_profile(module) for _ in range(args.runs)]
+        total, top = min(profiles)
+        over = total > args.max_import_ms
+        failed |= over
+        heaviest = ', '.join(f"{name} {ms:.0f}ms" for ms, name in top)
+        print(f"import {module:<8} {total:7.1f}ms  (limit {args.max_import_ms:.0f}ms)"
+              f"{'  OVER' if over else ''}  heaviest: {heaviest}")
+
+    # The handler logs to stdout too; the result is the last line.
+    runs = [json.loads(python(['-c', FIRST_UPDATE]).splitlines()[-1][len('result '):]) for _ in range(args.runs)]
+    best = min(runs, key=lambda r: r['total_ms'])
+    over = best['total_ms'] > args.max_first_update_ms
+    failed |= over
+    print(f"first update    {best['total_ms']:7.1f}ms  (limit {args.max_first_update_ms:.0f}ms)"
+          f"{'  OVER' if over else ''}  of it import handler {best['import_ms']:.0f}ms")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
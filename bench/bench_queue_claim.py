@@ -0,0 +1,92 @@
+"""Several workers draining processing_queue at once must grade every item exactly once.
+
+Starts N threads that call worker.handler in a loop against FakePostgrest
+(claim_queue_items mirrored in Python, with the same lock-per-statement
+semantics as Postgres) and a stubbed LLM. A few items start with an expired
+lease, as if a previous worker died mid-batch. Runs both with the RPC and
+with the row-by-row fallback and exits 1 on any duplicate or lost item.
+
+    python bench/bench_queue_claim.py --workers 4 --items 200
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('SUPABASE_URL', 'http://supabase.local')
+os.environ.setdefault('SUPABASE_KEY', 'bench')
+os.environ.setdefault('TELEGRAM_API_URL', 'http://telegram.local')
+# The fake Telegram has no global limit; the per-chat one still applies.
+os.environ.setdefault('TELEGRAM_GLOBAL_RPS', '0')
+# Every item must reach the (stubbed) LLM: no rate limit, no grade reuse.
+os.environ.setdefault('MISTRAL_RPS', '0')
+os.environ.setdefault('GRADING_CACHE_ENABLED', '0')
+
+import worker  # noqa: E402
+from bench.fakes import (FakePostgrest, FakeTelegram, install_postgrest,  # noqa: E402
+                         install_telegram, seed_catalog, _now)
+
+
+class FakeContext:
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+def run(workers: int, items: int, llm_seconds: float, use_rpc: bool) -> bool:
+    db = install_postgrest(FakePostgrest(rtt=0.002))
+    tg = install_telegram(FakeTelegram())
+    if not use_rpc:
+        del db.rpcs['claim_queue_items']
+    seed_catalog(db, 10)
+    for i in range(items):
+        row = {'chat_id': 1000 + i, 'user_id': 1000 + i, 'task_id': 1 + i % 10,
+               'user_answer_text': f"ответ {i}", 'status': 'pending', 'created_at': f"{i:08d}"}
+        if i % 25 == 0:
+            row.update(status='processing', lease_owner='dead-worker', lease_expires_at=_now(-60))
+        db.insert('processing_queue', row)
+
+    worker.evaluate_answer = lambda *args: (time.sleep(llm_seconds), '{"score": 1, "max_score": 2, "comment": "Хорошо."}')[1]
+
+    def drain():
+        while db.select('processing_queue', status='in.(pending,processing)'):
+            worker.handler({}, FakeContext())
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # worker logs
+        threads = [threading.Thread(target=drain) for _ in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    elapsed = time.perf_counter() - started
+
+    graded = Counter(a['user_id'] for a in db.tables['attempts'])
+    notified = Counter(chat for chat, messages in tg.messages.items() for _ in messages)
+    duplicates = sum(1 for n in graded.values() if n > 1) + sum(1 for n in notified.values() if n > 1)
+    lost = items - len(graded)
+    mode = 'rpc' if use_rpc else 'fallback'
+    print(f"{mode:<9} workers={workers} items={items} time={elapsed:.2f}s "
+          f"duplicates={duplicates} lost={lost}")
+    return duplicates == 0 and lost == 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--llm-ms', type=float, default=20.0)
+    args = parser.parse_args()
+
+    ok = True
+    for use_rpc in (True, False):
+        ok &= run(args.workers, args.items, args.llm_ms / 1000, use_rpc)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""The long-polling runner against the fake Telegram: ordering and throughput.
+
+Pushes a three-step dialog (task menu, category, answer) for every user into
+FakeTelegram's getUpdates queue, runs runner.Runner until everything is
+processed and checks that each user's updates were handled in order (every
+dialog must end with a queued answer). Runs once with concurrency 1 and once
+with the configured concurrency; exits 1 if any dialog broke.
+
+    python bench/bench_runner.py --users 40 --concurrency 8
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('SUPABASE_URL', 'http://supabase.local')
+os.environ.setdefault('SUPABASE_KEY', 'bench')
+os.environ.setdefault('TELEGRAM_API_URL', 'http://telegram.local')
+# The fake Telegram has no global limit; the per-chat one still applies.
+os.environ.setdefault('TELEGRAM_GLOBAL_RPS', '0')
+
+import handler  # noqa: E402
+import runner  # noqa: E402
+from bench.fakes import (FakePostgrest, FakeTelegram, install_postgrest,  # noqa: E402
+                         install_telegram, make_update, seed_catalog)
+
+DIALOG = ('📝 Получить задание', '📂 Категория 1', 'Мой ответ')
+
+
+def run(users: int, concurrency: int, rtt: float) -> bool:
+    db = install_postgrest(FakePostgrest(rtt=rtt))
+    tg = install_telegram(FakeTelegram(rtt=rtt, max_poll=0.05))
+    seed_catalog(db, 20)
+    update_id = 0
+    for step in DIALOG:
+        for i in range(users):
+            user_id = 7000 + i
+            if step == DIALOG[0]:
+                db.insert('users', {'user_id': user_id, 'username': f"user{user_id}",
+                                    'is_allowed': True, 'tasks_left': 10})
+            update_id += 1
+            tg.push_update(make_update(user_id, step, update_id))
+
+    seen = defaultdict(list)
+    lock = threading.Lock()
+    process_update = handler.process_update
+
+    def recording(update):
+        with lock:
+            seen[update['message']['from']['id']].append(update['message']['text'])
+        process_update(update)
+
+    async def main():
+        instance = runner.Runner(concurrency=concurrency, poll_timeout=1)
+        stop = asyncio.Event()
+
+        async def stop_when_done():
+            while sum(len(v) for v in seen.values()) < update_id or instance._pending:
+                await asyncio.sleep(0.01)
+            stop.set()
+
+        watcher = asyncio.create_task(stop_when_done())
+        try:
+            await instance.run(stop)
+        finally:
+            watcher.cancel()
+            instance.close()
+
+    handler.process_update = recording
+    started = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):  # handler logs
+            asyncio.run(main())
+    finally:
+        handler.process_update = process_update
+    elapsed = time.perf_counter() - started
+
+    in_order = sum(1 for texts in seen.values() if tuple(texts) == DIALOG)
+    queued = len({q['user_id'] for q in db.tables['processing_queue']})
+    print(f"concurrency={concurrency:<3} updates={update_id} time={elapsed:.2f}s "
+          f"updates/s={update_id / elapsed:6.1f} in_order={in_order}/{users} answers_queued={queued}/{users}")
+    return in_order == users and queued == users
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rtt-ms', type=float, default=5.0, help='latency of every fake request')
+    args = parser.parse_args()
+
+    ok = True
+    for concurrency in (1, args.concurrency):
+        ok &= run(args.users, concurrency, args.rtt_ms / 1000)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""Benchmark: get_random_task via the pick_random_task RPC vs the scan fallback.
+
+Runs against FakePostgrest seeded with 10k tasks and 5k attempts for one user
+(plus the matching solved_tasks rows the worker would have written).
+The fake adds a fixed round-trip time plus a transfer time per byte, so the
+numbers reflect both the number of requests and the payload size.
+
+    python bench/bench_task_selection.py --tasks 10000 --attempts 5000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('SUPABASE_URL', 'http://supabase.local')
+os.environ.setdefault('SUPABASE_KEY', 'bench')
+
+import handler  # noqa: E402
+from bench.fakes import FakePostgrest, install_postgrest, seed_catalog  # noqa: E402
+
+USER_ID = 1
+
+
+def run(db: FakePostgrest, fn, iterations: int):
+    timings = []
+    db.reset_counters()
+    for _ in range(iterations):
+        started = time.perf_counter()
+        task = fn(USER_ID, None)
+        timings.append((time.perf_counter() - started) * 1000)
+        assert task is not None
+    return {
+        'mean_ms': statistics.mean(timings),
+        'p95_ms': sorted(timings)[int(len(timings) * 0.95) - 1],
+        'requests': len(db.calls) / iterations,
+        'kb_per_call': db.bytes_out / iterations / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--attempts', type=int, default=5000)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--rtt-ms', type=float, default=20.0)
+    parser.add_argument('--mbps', type=float, default=50.0, help='simulated bandwidth, megabit/s')
+    args = parser.parse_args()
+
+    db = install_postgrest(FakePostgrest(rtt=args.rtt_ms / 1000, bandwidth=args.mbps * 1e6 / 8))
+    seed_catalog(db, args.tasks)
+    rng = random.Random(42)
+    for _ in range(args.attempts):
+        db.insert('attempts', {
+            'user_id': USER_ID,
+            'task_id': rng.randint(1, args.tasks),
+            'user_answer_text': 'ответ ' * 40,
+            'score': rng.choice([0, 1, 2]),
+            'max_score': 2,
+            'comment': 'комментарий ' * 40,
+        })
+    solved = {(a['user_id'], a['task_id']) for a in db.tables['attempts'] if a['score'] == a['max_score']}
+    for user_id, task_id in sorted(solved):
+        db.insert('solved_tasks', {'user_id': user_id, 'task_id': task_id})
+
+    results = {
+        'rpc': run(db, handler.get_random_task, args.iterations),
+        'scan': run(db, handler.get_random_task_scan, args.iterations),
+    }
+    print(f"{'path':<6}{'mean ms':>10}{'p95 ms':>10}{'requests':>10}{'KB/call':>12}")
+    for name, r in results.items():
+        print(f"{name:<6}{r['mean_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['requests']:>10.1f}{r['kb_per_call']:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Queue-to-result latency with a timer-only worker and with wake-up pushes.
+
+Users answer tasks through handler.handler at random moments. In timer mode
+the worker only runs every --tick seconds (a scaled-down CRON trigger); in
+push mode WORKER_WAKEUP_URL points at a local stand-in for an asynchronous
+function invocation that runs worker.handler with the queue id right away,
+while the timer keeps running as a sweeper. Latency is measured from the
+webhook reply to the result message reaching (fake) Telegram; empty scans
+are timer runs that found nothing to do.
+
+    python bench/bench_wakeup_latency.py --answers 30 --tick 2
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('SUPABASE_URL', 'http://supabase.local')
+os.environ.setdefault('SUPABASE_KEY', 'bench')
+os.environ.setdefault('TELEGRAM_API_URL', 'http://telegram.local')
+# The fake Telegram has no global limit; the per-chat one still applies.
+os.environ.setdefault('TELEGRAM_GLOBAL_RPS', '0')
+os.environ.setdefault('WORKER_WAKEUP_URL', 'http://worker.local/invoke')
+os.environ.setdefault('MISTRAL_RPS', '0')
+os.environ.setdefault('GRADING_CACHE_ENABLED', '0')
+
+import handler  # noqa: E402
+import http_client  # noqa: E402
+import worker  # noqa: E402
+from bench.fakes import FakePostgrest, FakeTelegram, install_postgrest, make_update, seed_catalog  # noqa: E402
+
+WAKEUP_URL = handler.WORKER_WAKEUP_URL
+
+
+class FakeContext:
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+class TimedTelegram(FakeTelegram):
+    """Remembers when the grading result reached each chat."""
+
+    def __init__(self):
+        super().__init__()
+        self.delivered = {}
+
+    def send(self, request, **kwargs):
+        payload = json.loads(request.body) if request.body else {}
+        if 'Проверка завершена' in (payload.get('text') or ''):
+            self.delivered.setdefault(payload['chat_id'], time.perf_counter())
+        return super().send(request, **kwargs)
+
+
+class FakeWorkerInvoke(BaseAdapter):
+    """Stand-in for an async function invocation: starts worker.handler and answers at once."""
+
+    def __init__(self, run_worker):
+        super().__init__()
+        self.run_worker = run_worker
+
+    def send(self, request, **kwargs):
+        event = json.loads(request.body)
+        threading.Thread(target=self.run_worker, args=(event,)).start()
+        response = Response()
+        response.status_code = 202
+        response._content = b'{}'
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def run(push: bool, answers: int, tick: float, gap: float, llm_seconds: float):
+    db = install_postgrest(FakePostgrest(rtt=0.002))
+    tg = TimedTelegram()
+    http_client.get_session().mount(http_client.TELEGRAM_API_URL, tg)
+    seed_catalog(db, 20)
+    worker.evaluate_answer = lambda *args: (time.sleep(llm_seconds),
+                                            '{"score": 1, "max_score": 2, "comment": "Хорошо."}')[1]
+
+    runs = {'timer': 0, 'empty': 0, 'push': 0}
+
+    def run_worker(event):
+        response = worker.handler(event, FakeContext())
+        kind = 'push' if event else 'timer'
+        runs[kind] += 1
+        if kind == 'timer' and response['body'] == 'Idle':
+            runs['empty'] += 1
+
+    http_client.get_session().mount(WAKEUP_URL, FakeWorkerInvoke(run_worker))
+    handler.WORKER_WAKEUP_URL = WAKEUP_URL if push else None
+
+    stop = threading.Event()
+
+    def timer():
+        while not stop.wait(tick):
+            run_worker({})
+
+    submitted = {}
+    with contextlib.redirect_stdout(io.StringIO()):  # handler and worker logs
+        sweeper = threading.Thread(target=timer)
+        sweeper.start()
+        for i in range(answers):
+            user_id = 5000 + i
+            db.insert('users', {'user_id': user_id, 'username': f"user{user_id}",
+                                'is_allowed': True, 'tasks_left': 10})
+            for update_id, text in enumerate(('📝 Получить задание', '📂 Категория 1'), start=1):
+                handler.handler({'body': json.dumps(make_update(user_id, text, update_id))}, None)
+            time.sleep(random.expovariate(1 / gap))
+            handler.handler({'body': json.dumps(make_update(user_id, 'Мой ответ', 3))}, None)
+            submitted[user_id] = time.perf_counter()
+        deadline = time.perf_counter() + tick * 2 + 5
+        while len(tg.delivered) < answers and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        stop.set()
+        sweeper.join()
+
+    latencies = sorted(tg.delivered[u] - t for u, t in submitted.items() if u in tg.delivered)
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)] if latencies else float('nan')
+    mode = 'push' if push else 'timer'
+    print(f"{mode:<6} delivered={len(latencies)}/{answers} "
+          f"p50={statistics.median(latencies) if latencies else float('nan'):.2f}s p95={p95:.2f}s "
+          f"worker runs: timer={runs['timer']} (empty {runs['empty']}) push={runs['push']}")
+    return len(latencies) == answers
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--answers', type=int, default=30)
+    parser.add_argument('--tick', type=float, default=2.0, help='timer period of the worker, seconds')
+    parser.add_argument('--gap-ms', type=float, default=100.0, help='mean pause between answers')
+    parser.add_argument('--llm-ms', type=float, default=50.0)
+    args = parser.parse_args()
+
+    random.seed(1)
+    ok = True
+    for push in (False, True):
+        ok &= run(push, args.answers, args.tick, args.gap_ms / 1000, args.llm_ms / 1000)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
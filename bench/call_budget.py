@@ -0,0 +1,70 @@
+"""Round-trip budget per update type for handler.handler.
+
+Replays a typical dialog against the in-process fakes, counts Supabase and
+Telegram requests for every update and fails (exit code 1) when an update
+type goes over its budget. A reply returned in the webhook response body
+costs no request and is shown as "+reply". Meant to run in CI next to the benchmarks:
+
+    python bench/call_budget.py
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('SUPABASE_URL', 'http://supabase.local')
+os.environ.setdefault('SUPABASE_KEY', 'bench')
+os.environ.setdefault('TELEGRAM_API_URL', 'http://telegram.local')
+
+import handler  # noqa: E402
+from bench.fakes import (FakePostgrest, FakeTelegram, install_postgrest,  # noqa: E402
+                         install_telegram, make_update, seed_catalog)
+
+USER_ID = 42
+
+# update name -> (text, max Supabase requests, max Telegram requests)
+BUDGET = {
+    'start': ('/start', 1, 0),
+    'task_menu': ('📝 Получить задание', 3, 0),
+    'pick_category': ('📂 Категория 1', 4, 0),
+    'answer': ('Мой развернутый ответ', 4, 0),
+    'statistics': ('📊 Моя статистика', 2, 0),
+    'reset': ('🔄 Сбросить рейтинг', 2, 0),
+}
+
+
+def measure(db: FakePostgrest, tg: FakeTelegram):
+    results = {}
+    for update_id, (name, (text, _, _)) in enumerate(BUDGET.items(), start=1):
+        db.reset_counters()
+        tg.reset_counters()
+        event = {'body': json.dumps(make_update(USER_ID, text, update_id))}
+        response = handler.handler(event, None)
+        assert response['statusCode'] == 200, response
+        replied = 'method' in json.loads(response['body'])
+        results[name] = (list(db.calls), list(tg.calls), replied)
+    return results
+
+
+def main() -> int:
+    db = install_postgrest(FakePostgrest())
+    tg = install_telegram(FakeTelegram())
+    seed_catalog(db, 20)
+    db.insert('users', {'user_id': USER_ID, 'username': f"user{USER_ID}", 'is_allowed': True, 'tasks_left': 100})
+    # One graded attempt so that statistics and reset have something to read.
+    db.insert('attempts', {'user_id': USER_ID, 'task_id': 1, 'score': 1, 'max_score': 2})
+    db.insert('user_stats', {'user_id': USER_ID, 'attempts': 1, 'percent_sum': 50, 'best_percent': 50,
+                             'by_category': {'Категория 1': {'attempts': 1, 'percent_sum': 50, 'best_percent': 50}}})
+
+    failed = False
+    for name, (sb_calls, tg_calls, replied) in measure(db, tg).items():
+        _, sb_budget, tg_budget = BUDGET[name]
+        ok = len(sb_calls) <= sb_budget and len(tg_calls) <= tg_budget
+        failed |= not ok
+        print(f"{'ok ' if ok else 'FAIL'} {name:<14} supabase {len(sb_calls)}/{sb_budget}"
+              f"  telegram {len(tg_calls)}/{tg_budget}{' +reply' if replied else '       '}  {', '.join(sb_calls)}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,583 @@
+"""In-process stand-ins for the external services used by the bot.
+
+FakePostgrest is mounted on the shared http_client session, so handler.py and
+worker.py run their real request code against in-memory tables. RPC functions
+from sql/ are mirrored in Python below. FakeMistral replaces the SDK client of
+worker.py. Every fake takes a latency (rtt plus random jitter) and an
+error_rate for failure injection.
+"""
+import inspect
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlsplit, parse_qsl
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+def _coerce(value: Any, raw: str) -> Any:
+    if isinstance(value, bool):
+        return raw == 'true'
+    if isinstance(value, (int, float)):
+        try:
+            return float(raw)
+        except ValueError:
+            return raw
+    return raw
+
+
+def _matches(row: Dict, column: str, expr: str) -> bool:
+    op, _, raw = expr.partition('.')
+    value = row.get(column)
+    if op == 'is':
+        return value is None if raw == 'null' else str(value).lower() == raw
+    if op == 'in':
+        options = [o.strip('"') for o in raw.strip('()').split(',') if o]
+        return value is not None and str(value) in options
+    if value is None:
+        return False
+    target = _coerce(value, raw.strip('"'))
+    if op == 'eq':
+        return (float(value) if isinstance(target, float) else str(value)) == target
+    if op == 'neq':
+        return (float(value) if isinstance(target, float) else str(value)) != target
+    current = float(value) if isinstance(target, float) else str(value)
+    if op == 'gt':
+        return current > target
+    if op == 'gte':
+        return current >= target
+    if op == 'lt':
+        return current < target
+    if op == 'lte':
+        return current <= target
+    raise ValueError(f"unsupported filter {column}={expr}")
+
+
+def _split_top(expr: str) -> List[str]:
+    parts, depth, current = [], 0, ''
+    for ch in expr:
+        if ch == ',' and depth == 0:
+            parts.append(current)
+            current = ''
+            continue
+        depth += ch == '('
+        depth -= ch == ')'
+        current += ch
+    return parts + [current] if current else parts
+
+
+def _matches_logic(row: Dict, op: str, expr: str) -> bool:
+    results = []
+    for part in _split_top(expr.strip()[1:-1]):
+        if part.startswith(('and(', 'or(')):
+            inner_op, _, inner = part.partition('(')
+            results.append(_matches_logic(row, inner_op, '(' + inner))
+        else:
+            column, _, condition = part.partition('.')
+            results.append(_matches(row, column, condition))
+    return all(results) if op == 'and' else any(results)
+
+
+def _row_matches(row: Dict, filters) -> bool:
+    for column, expr in filters:
+        if column in ('or', 'and'):
+            if not _matches_logic(row, column, expr):
+                return False
+        elif not _matches(row, column, expr):
+            return False
+    return True
+
+
+class FakePostgrest(BaseAdapter):
+    """A small subset of PostgREST: filters, select, order, limit, upsert and rpc."""
+
+    RESERVED = {'select', 'order', 'limit', 'offset', 'on_conflict'}
+
+    def __init__(self, rtt: float = 0.0, bandwidth: Optional[float] = None, jitter: float = 0.0,
+                 error_rate: float = 0.0, seed: Optional[int] = None):
+        super().__init__()
+        self.rtt = rtt
+        self.bandwidth = bandwidth  # bytes per second, None = unlimited
+        self.jitter = jitter  # extra latency, uniform in [0, jitter] seconds
+        self.error_rate = error_rate  # share of requests answered 503 without touching the tables
+        self.random = random.Random(seed)
+        self.tables: Dict[str, List[Dict]] = defaultdict(list)
+        self.primary_keys: Dict[str, str] = {'users': 'user_id', 'user_states': 'user_id', 'user_stats': 'user_id'}
+        self.rpcs: Dict[str, Callable] = dict(DEFAULT_RPCS)
+        self.views: Dict[str, Callable] = dict(DEFAULT_VIEWS)
+        self.lock = threading.RLock()
+        self._ids: Dict[str, int] = defaultdict(int)
+        self.calls: List[str] = []
+        self.calls_by_thread: Counter = Counter()
+        self.errors_injected = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    # ---- helpers for seeding and inspection ----
+    def insert(self, table: str, row: Dict) -> Dict:
+        with self.lock:
+            row = dict(row)
+            if 'id' not in row and self.primary_keys.get(table, 'id') == 'id':
+                self._ids[table] += 1
+                row['id'] = self._ids[table]
+            elif isinstance(row.get('id'), int):
+                self._ids[table] = max(self._ids[table], row['id'])
+            self.tables[table].append(row)
+            return row
+
+    def select(self, table: str, **filters) -> List[Dict]:
+        with self.lock:
+            return [r for r in self.tables[table] if _row_matches(r, filters.items())]
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    # ---- transport ----
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        path = parts.path.split('/rest/v1/', 1)[1]
+        params = parse_qsl(parts.query, keep_blank_values=True)
+        body = json.loads(request.body) if request.body else None
+        prefer = request.headers.get('Prefer', '')
+        self.calls.append(f"{request.method} {path}")
+
+        with self.lock:
+            self.calls_by_thread[threading.get_ident()] += 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors_injected += 1
+                status, payload = 503, {'message': 'injected failure'}
+            else:
+                try:
+                    status, payload = self._dispatch(request.method, path, params, body, prefer)
+                except KeyError as e:
+                    status, payload = 404, {'message': f"not found: {e}"}
+
+        content = b'' if payload is None else json.dumps(payload, default=str).encode()
+        self.bytes_in += len(request.body or b'')
+        self.bytes_out += len(content)
+        delay = self.rtt + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if self.bandwidth:
+            delay += (len(content) + len(request.body or b'')) / self.bandwidth
+        if delay:
+            time.sleep(delay)
+
+        response = Response()
+        response.status_code = status
+        response._content = content
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        return response
+
+    def close(self):
+        pass
+
+    def _dispatch(self, method, path, params, body, prefer):
+        minimal = 'return=minimal' in prefer
+        if path.startswith('rpc/'):
+            fn = self.rpcs[path[4:]]
+            try:
+                inspect.signature(fn).bind(self, **(body or {}))
+            except TypeError:
+                # PostgREST answers 404 when no function matches the argument names.
+                return 404, {'message': f"no function {path[4:]} with these arguments"}
+            return 200, fn(self, **(body or {}))
+
+        filters = [(k, v) for k, v in params if k not in self.RESERVED]
+        options = dict((k, v) for k, v in params if k in self.RESERVED)
+        source = self.views[path](self) if path in self.views else self.tables[path]
+        rows = [r for r in source if _row_matches(r, filters)]
+
+        if method == 'GET':
+            if 'order' in options:
+                for spec in reversed(options['order'].split(',')):
+                    column, _, direction = spec.partition('.')
+                    rows.sort(key=lambda r: (r.get(column) is None, r.get(column)),
+                              reverse=direction.startswith('desc'))
+            if 'offset' in options:
+                rows = rows[int(options['offset']):]
+            if 'limit' in options:
+                rows = rows[:int(options['limit'])]
+            return 200, self._project(rows, options.get('select'))
+
+        if method == 'POST':
+            items = body if isinstance(body, list) else [body]
+            conflict = options.get('on_conflict', self.primary_keys.get(path, 'id')).split(',')
+            result = []
+            for item in items:
+                existing = None
+                if 'resolution=' in prefer and all(c in item for c in conflict):
+                    existing = next((r for r in self.tables[path]
+                                     if all(r.get(c) == item[c] for c in conflict)), None)
+                if existing is not None:
+                    if 'merge-duplicates' in prefer:
+                        existing.update(item)
+                    result.append(existing)
+                else:
+                    result.append(self.insert(path, item))
+            return (201, None) if minimal else (201, self._project(result, options.get('select')))
+
+        if method == 'PATCH':
+            for row in rows:
+                row.update(body)
+            return (204, None) if minimal else (200, self._project(rows, options.get('select')))
+
+        if method == 'DELETE':
+            ids = {id(r) for r in rows}
+            self.tables[path] = [r for r in self.tables[path] if id(r) not in ids]
+            return (204, None) if minimal else (200, rows)
+
+        return 405, {'message': method}
+
+    @staticmethod
+    def _project(rows, select):
+        if not select or select == '*':
+            return [dict(r) for r in rows]
+        columns = select.split(',')
+        return [{c: r.get(c) for c in columns} for r in rows]
+
+
+class FakeTelegram(BaseAdapter):
+    """Accepts Bot API calls and keeps the sent messages per chat.
+
+    Updates added with push_update are served by getUpdates (long polling
+    is capped at max_poll seconds so tests do not hang). Injected errors are
+    429 answers with retry_after, the usual way Telegram refuses a message.
+    """
+
+    def __init__(self, rtt: float = 0.0, max_poll: float = 0.2, jitter: float = 0.0,
+                 error_rate: float = 0.0, retry_after: float = 1.0, seed: Optional[int] = None):
+        super().__init__()
+        self.rtt = rtt
+        self.max_poll = max_poll
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls: List[str] = []
+        self.calls_by_thread: Counter = Counter()
+        self.errors_injected = 0
+        self.messages: Dict[int, List[Dict]] = defaultdict(list)
+        self.updates: List[Dict] = []
+        self._has_updates = threading.Condition(self.lock)
+        self._message_id = 0
+
+    def push_update(self, update: Dict):
+        with self._has_updates:
+            self.updates.append(update)
+            self._has_updates.notify_all()
+
+    def _get_updates(self, payload: Dict) -> List[Dict]:
+        offset = payload.get('offset', 0)
+        with self._has_updates:
+            # Like Telegram: asking for an offset confirms every earlier update.
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            if not self.updates:
+                self._has_updates.wait(min(payload.get('timeout', 0), self.max_poll))
+            return list(self.updates[:payload.get('limit', 100)])
+
+    def send(self, request, **kwargs):
+        api_method = urlsplit(request.url).path.rsplit('/', 1)[1]
+        payload = json.loads(request.body) if request.body else {}
+        status, answer = 200, None
+        if api_method == 'getUpdates':
+            result = self._get_updates(payload)
+            with self.lock:
+                self.calls.append(api_method)
+        else:
+            with self.lock:
+                self.calls.append(api_method)
+                self.calls_by_thread[threading.get_ident()] += 1
+                if self.error_rate and self.random.random() < self.error_rate:
+                    self.errors_injected += 1
+                    status, answer = 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                                           'parameters': {'retry_after': self.retry_after}}
+                else:
+                    self._message_id += 1
+                    result = {'message_id': payload.get('message_id', self._message_id),
+                              'chat': {'id': payload.get('chat_id')}, 'text': payload.get('text')}
+                    self.messages[payload.get('chat_id')].append(
+                        dict(payload, method=api_method, sent_at=time.monotonic()))
+        delay = self.rtt + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+
+        response = Response()
+        response.status_code = status
+        response._content = json.dumps(answer or {'ok': True, 'result': result}).encode()
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        return response
+
+    def close(self):
+        pass
+
+    def reset_counters(self):
+        self.calls.clear()
+
+
+class FakeMistralError(Exception):
+    """Shaped like the SDK errors that call_llm inspects (status_code, headers)."""
+
+    def __init__(self, status_code: int, headers: Optional[Dict] = None):
+        super().__init__(f"Status {status_code}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeMistral:
+    """The part of the Mistral SDK client that worker.py uses.
+
+    Every answer gets half of the max score found in the prompt, in the JSON
+    contract (an array for batch prompts). A malformed_rate share of replies
+    is free text, so the repair path runs too; injected errors are 503.
+    """
+
+    _MAX_SCORE = re.compile(r"Максимальный балл: (\d+)")
+    _NUMBER = re.compile(r"### Номер (\d+)")
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 malformed_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls: Counter = Counter()
+        self.errors_injected = 0
+        self.beta = SimpleNamespace(conversations=SimpleNamespace(start=self._start, start_stream=self._start_stream))
+        self.chat = SimpleNamespace(complete=self._complete)
+
+    def _call(self, kind: str) -> bool:
+        """Counts and delays one request; returns True when the reply should be malformed."""
+        with self.lock:
+            self.calls[kind] += 1
+            failed = self.error_rate and self.random.random() < self.error_rate
+            malformed = self.malformed_rate and self.random.random() < self.malformed_rate
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+            self.errors_injected += int(bool(failed))
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise FakeMistralError(503)
+        return bool(malformed)
+
+    def _reply(self, prompt: str, malformed: bool) -> str:
+        scores = [int(m) for m in self._MAX_SCORE.findall(prompt)] or [2]
+        if malformed:
+            return f"Ответ в целом верный, ставлю {scores[0] / 2:g} балла."
+        numbers = self._NUMBER.findall(prompt)
+        if numbers:
+            return json.dumps([{'id': int(n), 'score': m / 2, 'comment': 'Частично верно.'}
+                               for n, m in zip(numbers, scores)], ensure_ascii=False)
+        return json.dumps({'score': scores[0] / 2, 'max_score': scores[0], 'comment': 'Частично верно.'},
+                          ensure_ascii=False)
+
+    def _start(self, agent_id=None, inputs: str = '', **kwargs):
+        content = self._reply(inputs, self._call('conversations'))
+        return SimpleNamespace(outputs=[SimpleNamespace(content=content)])
+
+    def _start_stream(self, agent_id=None, inputs: str = '', **kwargs):
+        content = self._reply(inputs, self._call('conversations'))
+        chunks = [content[i:i + 16] for i in range(0, len(content), 16)]
+        events = [SimpleNamespace(data=SimpleNamespace(type='message.output.delta', content=c)) for c in chunks]
+        return _Stream(events)
+
+    def _complete(self, model=None, messages=(), **kwargs):
+        self._call('chat')
+        prompt = messages[-1]['content'] if messages else ''
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self._reply(prompt, False)))])
+
+
+class _Stream:
+    def __init__(self, events):
+        self.events = events
+
+    def __enter__(self):
+        return iter(self.events)
+
+    def __exit__(self, *exc):
+        return False
+
+
+# ============= RPC mirrors of sql/ =============
+def rpc_pick_random_task(db: FakePostgrest, p_user_id, p_category=None):
+    solved = {s['task_id'] for s in db.tables['solved_tasks'] if s['user_id'] == p_user_id}
+    candidates = [t for t in db.tables['tasks']
+                  if t['id'] not in solved and (p_category is None or t.get('category') == p_category)]
+    if not candidates:
+        return []
+    task = random.choice(candidates)
+    return [{c: task.get(c) for c in ('id', 'category', 'text', 'max_score')}]
+
+
+def rpc_decrement_tasks_left(db: FakePostgrest, p_user_id):
+    user = next((u for u in db.tables['users'] if u['user_id'] == p_user_id), None)
+    if not user or user.get('tasks_left', 0) <= 0:
+        return None
+    user['tasks_left'] -= 1
+    return user['tasks_left']
+
+
+def rpc_submit_answer(db: FakePostgrest, p_chat_id, p_user_id, p_task_id, p_answer):
+    tasks_left = rpc_decrement_tasks_left(db, p_user_id)
+    if tasks_left is None:
+        return {'queue_id': None, 'tasks_left': 0}
+    item = db.insert('processing_queue', {
+        'chat_id': p_chat_id, 'user_id': p_user_id, 'task_id': p_task_id,
+        'user_answer_text': p_answer, 'status': 'pending', 'created_at': _now(),
+    })
+    return {'queue_id': item['id'], 'tasks_left': tasks_left}
+
+
+def _now(offset: float = 0.0) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=offset)).isoformat()
+
+
+def rpc_claim_queue_items(db: FakePostgrest, p_owner, p_limit, p_lease_seconds=120, p_ids=None):
+    now = _now()
+    candidates = [q for q in db.tables['processing_queue']
+                  if (q.get('status') == 'pending'
+                      or (q.get('status') == 'processing' and (q.get('lease_expires_at') or '') < now))
+                  and (p_ids is None or q['id'] in p_ids)]
+    candidates.sort(key=lambda q: q.get('created_at') or '')
+    claimed = []
+    for item in candidates[:p_limit]:
+        item.update(status='processing', lease_owner=p_owner, lease_expires_at=_now(p_lease_seconds))
+        claimed.append(dict(item))
+    return claimed
+
+
+def rpc_record_attempt_stats(db: FakePostgrest, p_rows):
+    recorded = 0
+    for row in sorted(p_rows, key=lambda r: r['user_id']):
+        if row.get('queue_id') is not None:
+            attempt = next((a for a in db.tables['attempts']
+                            if a.get('queue_id') == row['queue_id'] and not a.get('stats_recorded_at')), None)
+            if attempt is None:
+                continue
+            attempt['stats_recorded_at'] = _now()
+        category, percent = row.get('category') or '', int(row['percent'])
+        stats = next((s for s in db.tables['user_stats'] if s['user_id'] == row['user_id']), None)
+        if stats is None:
+            stats = {'user_id': row['user_id'], 'attempts': 0, 'percent_sum': 0, 'best_percent': 0, 'by_category': {}}
+            db.tables['user_stats'].append(stats)
+        per_category = stats['by_category'].setdefault(category, {'attempts': 0, 'percent_sum': 0, 'best_percent': 0})
+        for target in (stats, per_category):
+            target['attempts'] += 1
+            target['percent_sum'] += percent
+            target['best_percent'] = max(target['best_percent'], percent)
+        recorded += 1
+    return recorded
+
+
+def rpc_reset_user_progress(db: FakePostgrest, p_user_id):
+    user = next((u for u in db.tables['users'] if u['user_id'] == p_user_id), {})
+    reset_at = user.get('stats_reset_at')
+    current = any(a['user_id'] == p_user_id and (reset_at is None or (a.get('created_at') or _now()) > reset_at)
+                  for a in db.tables['attempts'])
+    solved = any(s['user_id'] == p_user_id for s in db.tables['solved_tasks'])
+    previous = 0
+    if current or solved:
+        stats = next((s for s in db.tables['user_stats'] if s['user_id'] == p_user_id), {})
+        previous = max(stats.get('attempts', 0), 1)
+        for user in db.tables['users']:
+            if user['user_id'] == p_user_id:
+                user['stats_reset_at'] = _now()
+        for table in ('user_stats', 'solved_tasks'):
+            db.tables[table] = [r for r in db.tables[table] if r['user_id'] != p_user_id]
+    return {'previous_attempts': previous}
+
+
+def rpc_refund_attempts(db: FakePostgrest, p_queue_ids):
+    refunded = [q for q in db.tables['processing_queue']
+                if q['id'] in p_queue_ids and q.get('status') == 'error' and not q.get('refunded_at')]
+    for q in refunded:
+        q['refunded_at'] = _now()
+        for user in db.tables['users']:
+            if user['user_id'] == q['user_id']:
+                user['tasks_left'] = user.get('tasks_left', 0) + 1
+    return len(refunded)
+
+
+def view_task_categories(db: FakePostgrest):
+    counts: Dict[str, int] = defaultdict(int)
+    for t in db.tables['tasks']:
+        if t.get('category'):
+            counts[t['category']] += 1
+    return [{'category': c, 'task_count': n} for c, n in counts.items()]
+
+
+DEFAULT_VIEWS: Dict[str, Callable] = {
+    'task_categories': view_task_categories,
+}
+
+DEFAULT_RPCS: Dict[str, Callable] = {
+    'pick_random_task': rpc_pick_random_task,
+    'decrement_tasks_left': rpc_decrement_tasks_left,
+    'submit_answer': rpc_submit_answer,
+    'claim_queue_items': rpc_claim_queue_items,
+    'record_attempt_stats': rpc_record_attempt_stats,
+    'reset_user_progress': rpc_reset_user_progress,
+    'refund_attempts': rpc_refund_attempts,
+}
+
+
+def install_postgrest(fake: FakePostgrest) -> FakePostgrest:
+    """Mounts the fake on the shared session for SUPABASE_URL."""
+    import http_client
+    http_client.get_session().mount(http_client.SUPABASE_URL, fake)
+    return fake
+
+
+def install_telegram(fake: FakeTelegram) -> FakeTelegram:
+    """Mounts the fake on the shared session for TELEGRAM_API_URL."""
+    import http_client
+    http_client.get_session().mount(http_client.TELEGRAM_API_URL, fake)
+    return fake
+
+
+def install_mistral(fake: FakeMistral) -> FakeMistral:
+    """Makes worker.py use the fake instead of creating an SDK client."""
+    import worker
+    worker._mistral_client = fake
+    return fake
+
+
+def make_update(user_id: int, text: str, update_id: int = 1) -> Dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'chat': {'id': user_id},
+            'from': {'id': user_id, 'username': f"user{user_id}"},
+            'text': text,
+        },
+    }
+
+
+def seed_catalog(db: FakePostgrest, tasks: int, categories: int = 8, text_size: int = 800):
+    filler = 'x' * text_size
+    for i in range(1, tasks + 1):
+        db.insert('tasks', {
+            'id': i,
+            'category': f"Категория {i % categories}",
+            'text': f"Задание {i}. {filler}",
+            'answer_key_text': f"Ключ {i}. {filler}",
+            'max_score': 2,
+        })
@@ -0,0 +1,359 @@
+"""Offline load test: a synthetic update stream through handler.handler, drained by worker.handler.
+
+Everything external is replaced by the in-process fakes (PostgREST, Telegram,
+Mistral), each with its own latency, jitter and injected error rate. The
+stream is JSON Lines, one Telegram update per line (or {"update": {...}});
+it is generated from --users/--rounds unless --stream is given, and
+--save-stream writes it out for replaying the same load later.
+
+--instances threads replay the stream like parallel function instances
+(updates of one user stay in order and on one thread) while --workers
+threads run worker.handler until the queue is empty. The report shows
+throughput, latency percentiles and round trips per update type, and
+queue-to-result latency of the answers. The exit code is 1 when a gate
+fails: a lost answer, a duplicate result without injected errors, or a
+--max-*/--min-* limit. With --baseline, the run is also compared with an
+earlier --report file within --tolerance.
+
+    python bench/loadtest.py --users 100 --rounds 3 --report out.json
+    python bench/loadtest.py --pg-error-rate 0.02 --llm-error-rate 0.05 --llm-malformed-rate 0.1
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('SUPABASE_URL', 'http://supabase.local')
+os.environ.setdefault('SUPABASE_KEY', 'bench')
+os.environ.setdefault('TELEGRAM_API_URL', 'http://telegram.local')
+# The fake Telegram has no global limit; the per-chat one still applies.
+os.environ.setdefault('TELEGRAM_GLOBAL_RPS', '0')
+os.environ.setdefault('MISTRAL_RPS', '0')
+# Injected LLM errors may open the breaker; keep it short so the drain goes on.
+os.environ.setdefault('MISTRAL_BREAKER_RESET_SECONDS', '1')
+
+import handler  # noqa: E402
+import worker  # noqa: E402
+from bench.fakes import (FakeMistral, FakePostgrest, FakeTelegram, install_mistral,  # noqa: E402
+                         install_postgrest, install_telegram, make_update, seed_catalog)
+
+MENU = '📝 Получить задание'
+RESULT_MARK = 'Проверка завершена'
+KINDS = ('start', 'task_menu', 'pick_category', 'answer', 'statistics', 'reset', 'other')
+
+
+class FakeContext:
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+# ============= Update stream =============
+def generate_stream(users: int, rounds: int, categories: int, seed: int) -> List[Dict]:
+    """/start, then `rounds` of menu -> category -> answer, then statistics, per user.
+
+    Users are interleaved at random, each user's own updates stay in order.
+    """
+    rng = random.Random(seed)
+    dialogs = {}
+    for n in range(users):
+        user_id = 10000 + n
+        texts = ['/start']
+        for r in range(rounds):
+            category = '🎲 Все категории' if rng.random() < 0.3 else f"📂 Категория {rng.randrange(categories)}"
+            texts += [MENU, category, f"Ответ пользователя {user_id}, попытка {r}: " + 'рассуждение ' * rng.randint(5, 40)]
+        texts.append('📊 Моя статистика')
+        dialogs[user_id] = texts
+    stream, update_id = [], 0
+    cursors = {user_id: 0 for user_id in dialogs}
+    while cursors:
+        user_id = rng.choice(list(cursors))
+        update_id += 1
+        stream.append(make_update(user_id, dialogs[user_id][cursors[user_id]], update_id))
+        cursors[user_id] += 1
+        if cursors[user_id] == len(dialogs[user_id]):
+            del cursors[user_id]
+    return stream
+
+
+def load_stream(path: str) -> List[Dict]:
+    with open(path, encoding='utf-8') as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    return [line.get('update', line) for line in lines]
+
+
+def save_stream(path: str, stream: List[Dict]):
+    with open(path, 'w', encoding='utf-8') as f:
+        for update in stream:
+            f.write(json.dumps(update, ensure_ascii=False) + '\n')
+
+
+def update_kind(update: Dict) -> str:
+    text = (update.get('message') or {}).get('text') or ''
+    if text.startswith('/start'):
+        return 'start'
+    if text == MENU:
+        return 'task_menu'
+    if text.startswith(('📂', '🎲')):
+        return 'pick_category'
+    if text.startswith('📊'):
+        return 'statistics'
+    if text.startswith('🔄'):
+        return 'reset'
+    return 'answer' if text and not text.startswith(('/', '⬅️')) else 'other'
+
+
+# ============= Measurements =============
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def replay(stream: List[Dict], instances: int, db: FakePostgrest, tg: FakeTelegram):
+    """Runs every update through handler.handler; returns per-update samples and answer times."""
+    lanes = defaultdict(list)
+    for update in stream:
+        user_id = update.get('message', {}).get('from', {}).get('id', 0)
+        lanes[user_id % instances].append(update)
+    samples, submitted = [], defaultdict(list)
+    lock = threading.Lock()
+
+    def run_lane(updates):
+        ident = threading.get_ident()
+        for update in updates:
+            sb_before, tg_before = db.calls_by_thread[ident], tg.calls_by_thread[ident]
+            started = time.perf_counter()
+            response = handler.handler({'body': json.dumps(update)}, None)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            replied = response['statusCode'] == 200 and 'method' in json.loads(response['body'])
+            kind = update_kind(update)
+            with lock:
+                samples.append({'kind': kind, 'ms': elapsed_ms, 'ok': response['statusCode'] == 200,
+                                'supabase': db.calls_by_thread[ident] - sb_before,
+                                'telegram': tg.calls_by_thread[ident] - tg_before, 'reply': replied})
+                if kind == 'answer':
+                    submitted[update['message']['chat']['id']].append(time.monotonic())
+
+    threads = [threading.Thread(target=run_lane, args=(updates,)) for updates in lanes.values()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples, submitted
+
+
+def drain(workers: int, replay_done: threading.Event, db: FakePostgrest, timeout: float) -> List[threading.Thread]:
+    """Starts `workers` threads calling worker.handler until the replay is over and the queue is empty."""
+    deadline = time.monotonic() + timeout
+
+    def open_items():
+        return db.select('processing_queue', status='in.(pending,processing)')
+
+    def loop():
+        while time.monotonic() < deadline:
+            if not open_items():
+                if replay_done.is_set():
+                    return
+                time.sleep(0.01)
+                continue
+            body = worker.handler({}, FakeContext()).get('body')
+            if body in ('Idle', 'Tasks unavailable', 'Attempts unavailable'):
+                time.sleep(0.01)
+
+    threads = [threading.Thread(target=loop) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    return threads
+
+
+def summarize(args, stream, samples, submitted, elapsed, drain_elapsed, db, tg, llm) -> Dict:
+    by_kind = defaultdict(list)
+    for s in samples:
+        by_kind[s['kind']].append(s)
+    kinds = {}
+    for kind in KINDS:
+        rows = by_kind.get(kind)
+        if not rows:
+            continue
+        ms = [r['ms'] for r in rows]
+        kinds[kind] = {
+            'updates': len(rows),
+            'p50_ms': round(percentile(ms, 0.5), 1),
+            'p95_ms': round(percentile(ms, 0.95), 1),
+            'p99_ms': round(percentile(ms, 0.99), 1),
+            'supabase_per_update': round(sum(r['supabase'] for r in rows) / len(rows), 2),
+            'telegram_per_update': round(sum(r['telegram'] for r in rows) / len(rows), 2),
+            'webhook_replies': sum(r['reply'] for r in rows),
+        }
+
+    queue = db.tables['processing_queue']
+    results = {chat: [m['sent_at'] for m in messages if RESULT_MARK in (m.get('text') or '')]
+               for chat, messages in tg.messages.items()}
+    queue_to_result = [(done - sent) * 1000 for chat, times in submitted.items()
+                       for sent, done in zip(times, sorted(results.get(chat, [])))]
+    graded = len(db.tables['attempts'])
+    delivered = sum(len(times) for times in results.values())
+    all_ms = [s['ms'] for s in samples]
+    return {
+        'updates': len(stream),
+        'instances': args.instances,
+        'workers': args.workers,
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(stream) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(all_ms, 0.5) or 0, 1),
+        'p95_ms': round(percentile(all_ms, 0.95) or 0, 1),
+        'p99_ms': round(percentile(all_ms, 0.99) or 0, 1),
+        'failed_updates': sum(1 for s in samples if not s['ok']),
+        'calls_per_update': round(sum(s['supabase'] + s['telegram'] for s in samples) / max(1, len(samples)), 2),
+        'kinds': kinds,
+        'grading': {
+            'queued': len(queue),
+            'graded': graded,
+            'errors': sum(1 for q in queue if q.get('status') == 'error'),
+            'lost': sum(1 for q in queue if q.get('status') in ('pending', 'processing')),
+            'duplicates': max(0, delivered - len(queue)),
+            'llm_calls_per_answer': round(sum(llm.calls.values()) / graded, 2) if graded else 0.0,
+            'repairs': llm.calls['chat'],
+            'drain_seconds': round(drain_elapsed, 3),
+            'queue_to_result_p50_ms': round(percentile(queue_to_result, 0.5) or 0, 1),
+            'queue_to_result_p95_ms': round(percentile(queue_to_result, 0.95) or 0, 1),
+        },
+        'injected_errors': {'supabase': db.errors_injected, 'telegram': tg.errors_injected,
+                            'mistral': llm.errors_injected},
+    }
+
+
+def print_report(report: Dict):
+    print(f"updates={report['updates']} instances={report['instances']} time={report['seconds']:.2f}s "
+          f"throughput={report['throughput']:.1f} updates/s failed={report['failed_updates']} "
+          f"p50={report['p50_ms']:.1f}ms p95={report['p95_ms']:.1f}ms p99={report['p99_ms']:.1f}ms "
+          f"calls/update={report['calls_per_update']:.2f}")
+    print(f"{'kind':<14}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'supabase':>10}{'telegram':>10}{'replies':>9}")
+    for kind, k in report['kinds'].items():
+        print(f"{kind:<14}{k['updates']:>6}{k['p50_ms']:>9.1f}{k['p95_ms']:>9.1f}{k['p99_ms']:>9.1f}"
+              f"{k['supabase_per_update']:>10.2f}{k['telegram_per_update']:>10.2f}{k['webhook_replies']:>9}")
+    g = report['grading']
+    print(f"grading: queued={g['queued']} graded={g['graded']} errors={g['errors']} lost={g['lost']} "
+          f"duplicates={g['duplicates']} llm_calls/answer={g['llm_calls_per_answer']:.2f} repairs={g['repairs']} "
+          f"drain={g['drain_seconds']:.2f}s queue_to_result p50={g['queue_to_result_p50_ms']:.0f}ms "
+          f"p95={g['queue_to_result_p95_ms']:.0f}ms")
+    e = report['injected_errors']
+    print(f"injected errors: supabase={e['supabase']} telegram={e['telegram']} mistral={e['mistral']}")
+
+
+# ============= Gates =============
+def check_gates(args, report: Dict) -> List[str]:
+    failures = []
+    g = report['grading']
+    if g['lost']:
+        failures.append(f"{g['lost']} answers were never graded")
+    injected = any(report['injected_errors'].values())
+    # With injected errors a retried write may repeat a result; that is at-least-once delivery.
+    if g['duplicates'] and not injected:
+        failures.append(f"{g['duplicates']} duplicate results")
+    if args.max_p95_ms is not None and report['p95_ms'] > args.max_p95_ms:
+        failures.append(f"p95 {report['p95_ms']}ms > {args.max_p95_ms}ms")
+    if args.min_throughput is not None and report['throughput'] < args.min_throughput:
+        failures.append(f"throughput {report['throughput']} < {args.min_throughput} updates/s")
+    if args.max_calls_per_update is not None and report['calls_per_update'] > args.max_calls_per_update:
+        failures.append(f"calls/update {report['calls_per_update']} > {args.max_calls_per_update}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        slack = 1 + args.tolerance
+        if report['throughput'] * slack < baseline['throughput']:
+            failures.append(f"throughput {report['throughput']} vs baseline {baseline['throughput']}")
+        if report['p95_ms'] > baseline['p95_ms'] * slack:
+            failures.append(f"p95 {report['p95_ms']}ms vs baseline {baseline['p95_ms']}ms")
+        # Round trips are deterministic for the same stream, so no tolerance here.
+        if report['calls_per_update'] > baseline['calls_per_update'] + 0.01:
+            failures.append(f"calls/update {report['calls_per_update']} vs baseline {baseline['calls_per_update']}")
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    load = parser.add_argument_group('load')
+    load.add_argument('--users', type=int, default=50)
+    load.add_argument('--rounds', type=int, default=3, help='tasks answered per user')
+    load.add_argument('--tasks', type=int, default=200)
+    load.add_argument('--categories', type=int, default=8)
+    load.add_argument('--instances', type=int, default=8, help='parallel handler invocations')
+    load.add_argument('--workers', type=int, default=2, help='parallel worker invocations')
+    load.add_argument('--stream', help='replay this JSON Lines file instead of generating a stream')
+    load.add_argument('--save-stream', help='write the replayed stream to this file')
+    load.add_argument('--seed', type=int, default=1)
+    load.add_argument('--drain-timeout', type=float, default=120.0)
+
+    fakes = parser.add_argument_group('fake services')
+    fakes.add_argument('--pg-ms', type=float, default=5.0, help='PostgREST round trip')
+    fakes.add_argument('--pg-jitter-ms', type=float, default=5.0)
+    fakes.add_argument('--pg-error-rate', type=float, default=0.0)
+    fakes.add_argument('--tg-ms', type=float, default=20.0, help='Telegram round trip')
+    fakes.add_argument('--tg-jitter-ms', type=float, default=10.0)
+    fakes.add_argument('--tg-error-rate', type=float, default=0.0, help='share of 429 answers')
+    fakes.add_argument('--llm-ms', type=float, default=200.0, help='Mistral response time')
+    fakes.add_argument('--llm-jitter-ms', type=float, default=100.0)
+    fakes.add_argument('--llm-error-rate', type=float, default=0.0)
+    fakes.add_argument('--llm-malformed-rate', type=float, default=0.0)
+
+    gates = parser.add_argument_group('gates')
+    gates.add_argument('--max-p95-ms', type=float)
+    gates.add_argument('--min-throughput', type=float, help='updates per second')
+    gates.add_argument('--max-calls-per-update', type=float)
+    gates.add_argument('--report', help='write the report as JSON (usable as a --baseline later)')
+    gates.add_argument('--baseline', help='fail when worse than this earlier --report')
+    gates.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    seed = args.seed
+    db = install_postgrest(FakePostgrest(rtt=args.pg_ms / 1000, jitter=args.pg_jitter_ms / 1000,
+                                         error_rate=args.pg_error_rate, seed=seed))
+    tg = install_telegram(FakeTelegram(rtt=args.tg_ms / 1000, jitter=args.tg_jitter_ms / 1000,
+                                       error_rate=args.tg_error_rate, retry_after=0.2, seed=seed + 1))
+    llm = install_mistral(FakeMistral(latency=args.llm_ms / 1000, jitter=args.llm_jitter_ms / 1000,
+                                      error_rate=args.llm_error_rate, malformed_rate=args.llm_malformed_rate,
+                                      seed=seed + 2))
+    random.seed(seed)  # pick_random_task of the fake
+    seed_catalog(db, args.tasks, args.categories)
+
+    stream = load_stream(args.stream) if args.stream else generate_stream(args.users, args.rounds,
+                                                                          args.categories, seed)
+    if args.save_stream:
+        save_stream(args.save_stream, stream)
+
+    replay_done = threading.Event()
+    with contextlib.redirect_stdout(io.StringIO()):  # handler, worker and trace logs
+        started = time.perf_counter()
+        drainers = drain(args.workers, replay_done, db, args.drain_timeout)
+        samples, submitted = replay(stream, args.instances, db, tg)
+        elapsed = time.perf_counter() - started
+        replay_done.set()
+        for t in drainers:
+            t.join()
+        drain_elapsed = time.perf_counter() - started
+
+    report = summarize(args, stream, samples, submitted, elapsed, drain_elapsed, db, tg, llm)
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failures = check_gates(args, report)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
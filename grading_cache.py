@@ -0,0 +1,116 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Iterable, Tuple
+
+from http_client import supabase_request
+
+# ============= Grading cache =============
+# Identical (after normalization) answers to the same task with the same
+# answer key get the same grade, so the worker can reuse it instead of
+# calling the LLM. A local LRU sits in front of the grading_cache table.
+GRADING_CACHE_SIZE = int(os.environ.get('GRADING_CACHE_SIZE', '2048'))
+GRADING_CACHE_ENABLED = os.environ.get('GRADING_CACHE_ENABLED', '1') == '1'
+REMOTE_RETRY_SECONDS = 300
+
+_WHITESPACE = re.compile(r'\s+')
+# Only punctuation that does not change the meaning is folded: quotes, ?;,
+# commas/periods outside numbers, and ! or : ending a word ("Ответ: 5").
+# Signs, decimal separators, brackets, slashes and other operators are kept,
+# so "x = -5" and "x = 5" differ, and so do "5!" (factorial) and "a:b" (ratio).
+_QUOTES_AND_MARKS = re.compile(r'["\'`«»„“”‘’?;]')
+_WORD_END_MARK = re.compile(r'(?<=[^\W\d_]{2})[!:](?=\s|$)')
+_DECIMAL_COMMA = re.compile(r'(?<=\d),(?=\d)')
+_SEPARATOR = re.compile(r'(?<!\d)[.,]|[.,](?!\d)')
+
+_local: "OrderedDict[Tuple[int, str, str], Dict]" = OrderedDict()
+_lock = threading.Lock()
+_remote_retry_at = 0.0
+
+CacheKey = Tuple[int, str, str]
+
+
+def normalize_answer(text: str) -> str:
+    # Case, whitespace and sentence punctuation do not change the meaning of an answer.
+    text = unicodedata.normalize('NFKC', text).casefold().replace('ё', 'е')
+    text = _DECIMAL_COMMA.sub('.', text)
+    text = _SEPARATOR.sub(' ', _WORD_END_MARK.sub(' ', _QUOTES_AND_MARKS.sub(' ', text)))
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+def answer_hash(text: str) -> str:
+    return hashlib.sha256(normalize_answer(text).encode('utf-8')).hexdigest()
+
+
+# Bumped when the format of the stored comment changes.
+GRADE_FORMAT_VERSION = 'json-1'
+
+
+def key_version(task: Dict) -> str:
+    """Changes whenever the answer key or the max score of the task changes."""
+    raw = f"{task.get('answer_key_text')}\x00{task.get('max_score')}\x00{GRADE_FORMAT_VERSION}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:16]
+
+
+def cache_key(task: Dict, user_answer: str) -> CacheKey:
+    return task['id'], key_version(task), answer_hash(user_answer)
+
+
+def _remember(key: CacheKey, grade: Dict):
+    with _lock:
+        _local[key] = grade
+        _local.move_to_end(key)
+        while len(_local) > GRADING_CACHE_SIZE:
+            _local.popitem(last=False)
+
+
+def lookup_many(keys: Iterable[CacheKey]) -> Dict[CacheKey, Dict]:
+    """Returns {key: {'score', 'max_score', 'comment'}} for the cached keys.
+
+    The local LRU is checked first, the rest is looked up in one request.
+    """
+    global _remote_retry_at
+    if not GRADING_CACHE_ENABLED:
+        return {}
+    found: Dict[CacheKey, Dict] = {}
+    missing = set()
+    with _lock:
+        for key in keys:
+            if key in _local:
+                _local.move_to_end(key)
+                found[key] = _local[key]
+            else:
+                missing.add(key)
+
+    if missing and time.monotonic() >= _remote_retry_at:
+        rows = supabase_request('GET', 'grading_cache', params={
+            'answer_hash': f"in.({','.join(sorted({k[2] for k in missing}))})",
+            'select': 'task_id,key_version,answer_hash,score,max_score,comment',
+        })
+        if rows is None:
+            _remote_retry_at = time.monotonic() + REMOTE_RETRY_SECONDS
+        for row in rows or []:
+            key = (row['task_id'], row['key_version'], row['answer_hash'])
+            if key in missing:
+                grade = {'score': row['score'], 'max_score': row['max_score'], 'comment': row['comment']}
+                _remember(key, grade)
+                found[key] = grade
+    return found
+
+
+def store_many(grades: Dict[CacheKey, Dict]):
+    """Saves fresh grades locally and in the grading_cache table (one upsert)."""
+    if not GRADING_CACHE_ENABLED or not grades:
+        return
+    for key, grade in grades.items():
+        _remember(key, grade)
+    if time.monotonic() < _remote_retry_at:
+        return
+    rows = [{'task_id': k[0], 'key_version': k[1], 'answer_hash': k[2], **g} for k, g in grades.items()]
+    supabase_request('POST', 'grading_cache', data=rows,
+                     params={'on_conflict': 'task_id,key_version,answer_hash'},
+                     prefer='resolution=ignore-duplicates,return=minimal')
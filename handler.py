@@ -1,80 +1,89 @@
 
 import json
 import os
-import requests
 import time
-import uuid
-import urllib3
-from datetime import datetime, timedelta
+from dataclasses import dataclass, field
+from datetime import datetime
 from typing import Optional, Dict, Any
 import random
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-# =========Configuration =============
-TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
-SUPABASE_URL = os.environ.get('SUPABASE_URL')
-SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
+from state_store import get_state as get_user_state, set_state as set_user_state, clear_state as clear_user_state
+import task_cache
+import telegram_sender
+import tracing
+from http_client import supabase_request, supabase_rpc, RpcUnavailable, notify_url
 
-
-
-
-# ============= SUPABASE API =============
-def supabase_request(method: str, table: str, data: Optional[Dict] = None, params: Optional[Dict] = None) -> Any:
-    url = f"{SUPABASE_URL}/rest/v1/{table}"
-    headers = {
-        'apikey': SUPABASE_KEY,
-        'Authorization': f'Bearer {SUPABASE_KEY}',
-        'Content-Type': 'application/json',
-        'Prefer': 'return=representation'
-    }
+# ============= Task helper =============
+# Columns the bot needs to show a task; the answer key stays in the database.
+TASK_COLUMNS = 'id,category,text,max_score'
+
+# If a database function is not deployed, the fallback path is used for
+# RPC_RETRY_SECONDS instead of probing the RPC on every request.
+RPC_RETRY_SECONDS = 300
+_task_rpc_retry_at = 0.0
+_submit_rpc_retry_at = 0.0
+_decrement_rpc_retry_at = 0.0
+_reset_rpc_retry_at = 0.0
+_solved_table_retry_at = 0.0
+
+
+def get_random_task(user_id: int, category: Optional[str] = None, since: Optional[str] = None) -> Optional[Dict]:
+    # Receives a random task that has not yet been solved by a maximum score.
+    global _task_rpc_retry_at
+    if category == 'all':
+        category = None
+
+    if time.monotonic() >= _task_rpc_retry_at:
+        try:
+            tasks = supabase_rpc('pick_random_task', {'p_user_id': user_id, 'p_category': category})
+            if tasks is not None:
+                return tasks[0] if tasks else None
+        except RpcUnavailable:
+            print("⚠️ pick_random_task RPC unavailable, falling back to scan")
+            _task_rpc_retry_at = time.monotonic() + RPC_RETRY_SECONDS
+
+    return get_random_task_scan(user_id, category, since)
+
+
+def get_solved_task_ids(user_id: int, since: Optional[str] = None) -> set:
+    # The solved set kept by the worker (sql/010_solved_tasks.sql) ...
+    global _solved_table_retry_at
+    if time.monotonic() >= _solved_table_retry_at:
+        rows = supabase_request('GET', 'solved_tasks', params={'user_id': f'eq.{user_id}', 'select': 'task_id'})
+        if rows is not None:
+            return {r['task_id'] for r in rows}
+        _solved_table_retry_at = time.monotonic() + RPC_RETRY_SECONDS
+
+    # ... or, without the table, recomputed from the attempts since the last reset.
+    attempts_params = {'user_id': f'eq.{user_id}', 'select': 'task_id,score,max_score'}
+    if since:
+        attempts_params['created_at'] = f'gt.{since}'
+    attempts = supabase_request('GET', 'attempts', params=attempts_params)
     
-    try:
-        if method == 'GET':
-            response = requests.get(url, headers=headers, params=params, timeout=10)
-        elif method == 'POST':
-            response = requests.post(url, headers=headers, json=data, timeout=10)
-        elif method == 'PATCH':
-            response = requests.patch(url, headers=headers, json=data, params=params, timeout=10)
-        elif method == 'DELETE':  # <--- ADD THIS BLOCK
-            response = requests.delete(url, headers=headers, params=params, timeout=10)
-        else:
-            raise ValueError(f"Неподдерживаемый метод: {method}")
-        
-        #DELETE might return 204 No Content, which has no JSON.
-        if response.status_code == 204:
-            return None
+    solved_task_ids = set()
+    if attempts:
+        for attempt in attempts:
             
-        response.raise_for_status()
-        return response.json()
-        
-    except Exception as e:
-        print(f"❌ Ошибка Supabase запроса: {method} {url} with params {params} -> {e}")
-        return None
+            score = attempt.get('score')
+            max_score = attempt.get('max_score')
+            
+            score_val = float(score) if score is not None else 0.0
+            max_score_val = float(max_score) if max_score is not None else 0.0
+            
+            if max_score_val > 0 and score_val >= (max_score_val - 0.1):
+                solved_task_ids.add(attempt['task_id'])
+    return solved_task_ids
 
-# ============= Task helper =============
-def get_random_task(user_id: int, category: Optional[str] = None) -> Optional[Dict]:
-   #Receives a random task that has not yet been solved by a maximum score.
+
+def get_random_task_scan(user_id: int, category: Optional[str] = None, since: Optional[str] = None) -> Optional[Dict]:
+    # Fallback: downloads the solved set and tasks and filters them in Python.
     try:
         # 1. Get solved tasks id
-        attempts_params = {'user_id': f'eq.{user_id}'}
-        attempts = supabase_request('GET', 'attempts', params=attempts_params)
-        
-        solved_task_ids = set()
-        if attempts:
-            for attempt in attempts:
-                
-                score = attempt.get('score')
-                max_score = attempt.get('max_score')
-                
-                score_val = float(score) if score is not None else 0.0
-                max_score_val = float(max_score) if max_score is not None else 0.0
-                
-                if max_score_val > 0 and score_val >= (max_score_val - 0.1):
-                    solved_task_ids.add(attempt['task_id'])
+        solved_task_ids = get_solved_task_ids(user_id, since)
 
         # 2. Get all tasks with category
-        task_params = {}
-        if category and category != 'all':
+        task_params = {'select': TASK_COLUMNS}
+        if category:
             task_params['category'] = f'eq.{category}'
             
         tasks = supabase_request('GET', 'tasks', params=task_params)
@@ -114,11 +123,29 @@ def add_to_processing_queue(chat_id: int, user_id: int, task_id: int, user_answe
         print(f"❌ Ошибка добавления в очередь: {e}")
         return None
 
+# ============= Worker wake-up =============
+# Optional push to the worker right after an answer is queued, e.g. the URL
+# of an asynchronous function invocation or of a message-queue gateway.
+# The timer-triggered worker keeps running as a sweeper for anything missed.
+WORKER_WAKEUP_URL = os.environ.get('WORKER_WAKEUP_URL')
+WORKER_WAKEUP_AUTH = os.environ.get('WORKER_WAKEUP_AUTH')
+WORKER_WAKEUP_TIMEOUT = float(os.environ.get('WORKER_WAKEUP_TIMEOUT', '0.3'))
+
+
+def wake_worker(queue_ids):
+    if not WORKER_WAKEUP_URL or not queue_ids:
+        return
+    headers = {'Authorization': WORKER_WAKEUP_AUTH} if WORKER_WAKEUP_AUTH else None
+    notify_url(WORKER_WAKEUP_URL, {'queue_ids': list(queue_ids)}, timeout=WORKER_WAKEUP_TIMEOUT, headers=headers)
+
 # ============= TELEGRAM API =============
+# Replies are queued while an update is processed (telegram_sender.collect)
+# and sent when it is done; a single reply goes back as the webhook response.
+TELEGRAM_WEBHOOK_REPLY = os.environ.get('TELEGRAM_WEBHOOK_REPLY', '1') == '1'
+
+
 def send_telegram_message(chat_id: int, text: str, reply_markup: Optional[Dict] = None):
     
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    
     payload = {
         'chat_id': chat_id,
         'text': text,
@@ -128,35 +155,99 @@ def send_telegram_message(chat_id: int, text: str, reply_markup: Optional[Dict]
     if reply_markup:
         payload['reply_markup'] = reply_markup
     
+    outbox = telegram_sender.current()
+    if outbox is not None:
+        outbox.add('sendMessage', payload)
+        return None
+
     try:
-        response = requests.post(url, json=payload, timeout=5)
-        response.raise_for_status()
-        return response.json()
+        return telegram_sender.send('sendMessage', payload)
     except Exception as e:
         print(f"❌ Ошибка отправки сообщения в Telegram: {e}")
         raise
 
 # --- Helper to get categories ---
-def get_categories() -> list:
+# The index lives at module level, so warm invocations reuse it until the TTL
+# runs out. The TTL is the only refresh path: every function instance keeps
+# its own copy, so new categories show up within CATEGORY_CACHE_TTL seconds.
+CATEGORY_CACHE_TTL = int(os.environ.get('CATEGORY_CACHE_TTL', '300'))
+_category_index: Dict[str, Any] = {'expires_at': 0.0, 'counts': {}, 'categories': [], 'keyboard': None}
+_category_view_retry_at = 0.0
+
+
+def load_category_counts() -> Optional[Dict[str, int]]:
+    # Prefers the task_categories view (one row per category), otherwise
+    # counts categories of all tasks. Returns None on error.
+    global _category_view_retry_at
+    if time.monotonic() >= _category_view_retry_at:
+        rows = supabase_request('GET', 'task_categories', params={'select': 'category,task_count'})
+        if rows is not None:
+            return {r['category']: r['task_count'] for r in rows if r.get('category')}
+        _category_view_retry_at = time.monotonic() + RPC_RETRY_SECONDS
+
+    rows = supabase_request('GET', 'tasks', params={'select': 'category'})
+    if rows is None:
+        return None
+    counts: Dict[str, int] = {}
+    for r in rows:
+        if r.get('category'):
+            counts[r['category']] = counts.get(r['category'], 0) + 1
+    return counts
+
+
+def get_category_index() -> Dict[str, Any]:
+    """Returns {'counts', 'categories', 'keyboard'}, reloading it when stale."""
+    if time.monotonic() < _category_index['expires_at']:
+        return _category_index
+
     try:
-        response = supabase_request('GET', 'tasks', params={'select': 'category'})
-        if not response: return []
-        
-        categories = sorted(list(set(r['category'] for r in response if r.get('category'))))
-        return categories
+        counts = load_category_counts()
     except Exception as e:
         print(f"Error fetching categories: {e}")
-        return []
+        counts = None
+    if counts is None:
+        # Keep serving the previous index rather than an empty menu.
+        return _category_index
+
+    categories = sorted(counts)
+    _category_index.update({
+        'expires_at': time.monotonic() + CATEGORY_CACHE_TTL,
+        'counts': counts,
+        'categories': categories,
+        'keyboard': freeze_keyboard(get_categories_keyboard(categories)),
+    })
+    return _category_index
+
+
+def get_categories() -> list:
+    return get_category_index()['categories']
 
 # ---Keyboard Generators ---
+# Keyboards are built once and shared between updates, so they are read-only.
+class FrozenDict(dict):
+    """A dict that refuses changes; still serializes as a plain JSON object."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("keyboard is shared and read-only")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+
+def freeze_keyboard(keyboard: Dict) -> FrozenDict:
+    return FrozenDict(keyboard, keyboard=tuple(tuple(FrozenDict(b) for b in row) for row in keyboard['keyboard']))
+
+
+MAIN_KEYBOARD = freeze_keyboard({
+    'keyboard': [
+        [{'text': '📝 Получить задание'}],
+        [{'text': '📊 Моя статистика'}, {'text': '🔄 Сбросить рейтинг'}]
+    ],
+    'resize_keyboard': True
+})
+
+
 def get_main_keyboard():
-    return {
-        'keyboard': [
-            [{'text': '📝 Получить задание'}],
-            [{'text': '📊 Моя статистика'}, {'text': '🔄 Сбросить рейтинг'}]
-        ],
-        'resize_keyboard': True
-    }
+    return MAIN_KEYBOARD
 def get_categories_keyboard(categories):
     keyboard = []
     # Add "All Categories" button first
@@ -179,6 +270,37 @@ def get_categories_keyboard(categories):
         'keyboard': keyboard,
         'resize_keyboard': True
     }
+# ============= Update context =============
+_NOT_LOADED = object()
+
+
+@dataclass
+class UpdateContext:
+    """Request-scoped data for one update.
+
+    Created once in process_update; the user row and the dialog state are
+    fetched at most once and shared by all handlers of the update.
+    """
+    chat_id: int
+    user_id: int
+    username: Optional[str] = None
+    user: Optional[Dict] = None
+    _state: Any = field(default=_NOT_LOADED, repr=False)
+
+    @property
+    def state(self) -> Optional[Dict]:
+        if self._state is _NOT_LOADED:
+            self._state = get_user_state(self.user_id)
+        return self._state
+
+    def set_state(self, state: str, data: Optional[Dict] = None):
+        set_user_state(self.user_id, state, data)
+        self._state = {'user_id': self.user_id, 'state': state, 'data': data or {}}
+
+    def clear_state(self):
+        clear_user_state(self.user_id)
+        self._state = None
+
 # ============= ЛОГИКА ПОЛЬЗОВАТЕЛЕЙ =============
 
 def get_or_create_user(user_id: int, username: str = None) -> Dict:
@@ -206,73 +328,73 @@ def get_or_create_user(user_id: int, username: str = None) -> Dict:
         print(f"❌ Ошибка при работе с пользователем: {e}")
         return None
 
-def decrease_user_tasks(user_id: int):
+def decrease_user_tasks(ctx: UpdateContext) -> Optional[int]:
+    """Atomically takes one attempt from the balance and returns the new value.
+
+    Returns None when nothing was taken (balance exhausted or DB error).
+    """
+    global _decrement_rpc_retry_at
     try:
-        user = supabase_request('GET', 'users', params={'user_id': f'eq.{user_id}'})
-        if user:
-            current = user[0].get('tasks_left', 0)
-            if current > 0:
-                supabase_request('PATCH', 'users', 
-                               params={'user_id': f'eq.{user_id}'}, 
-                               data={'tasks_left': current - 1})
+        if time.monotonic() >= _decrement_rpc_retry_at:
+            try:
+                tasks_left = supabase_rpc('decrement_tasks_left', {'p_user_id': ctx.user_id})
+                if tasks_left is not None:
+                    ctx.user['tasks_left'] = tasks_left
+                return tasks_left
+            except RpcUnavailable:
+                _decrement_rpc_retry_at = time.monotonic() + RPC_RETRY_SECONDS
+
+        # Fallback: conditional PATCH based on the balance loaded into the context.
+        current = ctx.user.get('tasks_left', 0)
+        if current > 0:
+            updated = supabase_request('PATCH', 'users', 
+                           params={'user_id': f'eq.{ctx.user_id}', 'tasks_left': f'eq.{current}'}, 
+                           data={'tasks_left': current - 1})
+            if updated:
+                ctx.user['tasks_left'] = current - 1
+                return current - 1
     except Exception as e:
         print(f"❌ Ошибка списания баланса: {e}")
+    return None
 
-# ============= User states =============
 
-def set_user_state(user_id: int, state: str, data: Optional[Dict] = None):
-    payload = {
-        'user_id': user_id,
-        'state': state,
-        'data': data or {},
-        'updated_at': datetime.utcnow().isoformat()
-    }
-    
-    
-    try:
-        existing = supabase_request('GET', 'user_states', params={'user_id': f'eq.{user_id}'})
-        
-        if existing:
-            supabase_request('PATCH', 'user_states', 
-                           params={'user_id': f'eq.{user_id}'}, 
-                           data=payload)
-        else:
-            supabase_request('POST', 'user_states', data=payload)
-            
-    except Exception as e:
-        print(f"❌ Ошибка сохранения состояния: {e}")
+def submit_answer(ctx: UpdateContext, task_id: int, answer_text: str) -> Optional[Dict]:
+    """Checks the balance, takes one attempt and enqueues the answer.
 
+    With the submit_answer function deployed this is one transactional round
+    trip. Returns {'queue_id', 'tasks_left'} where queue_id is None if the
+    balance is exhausted, or None on error.
+    """
+    global _submit_rpc_retry_at
+    if time.monotonic() >= _submit_rpc_retry_at:
+        try:
+            result = supabase_rpc('submit_answer', {
+                'p_chat_id': ctx.chat_id,
+                'p_user_id': ctx.user_id,
+                'p_task_id': task_id,
+                'p_answer': answer_text,
+            })
+            if result is not None and result.get('queue_id') is not None:
+                ctx.user['tasks_left'] = result['tasks_left']
+                print(f"✅ Задача добавлена в очередь (queue_id: {result['queue_id']})")
+            return result
+        except RpcUnavailable:
+            _submit_rpc_retry_at = time.monotonic() + RPC_RETRY_SECONDS
 
-def get_user_state(user_id: int) -> Optional[Dict]:
-    try:
-        response = supabase_request('GET', 'user_states', params={'user_id': f'eq.{user_id}'})
-        
-        if not response:
-            return None
-            
-        state_record = response[0]
-        
-        updated_at = datetime.fromisoformat(state_record['updated_at'].replace('Z', '+00:00'))
-        if (datetime.utcnow().replace(tzinfo=None) - updated_at.replace(tzinfo=None)) > timedelta(hours=24):
-            clear_user_state(user_id)
-            return None
-            
-        return state_record
-        
-    except Exception as e:
-        print(f"❌ Ошибка получения состояния: {e}")
+    queue_item = add_to_processing_queue(
+        chat_id=ctx.chat_id,
+        user_id=ctx.user_id,
+        task_id=task_id,
+        user_answer=answer_text
+    )
+    if not queue_item:
         return None
-
-
-def clear_user_state(user_id: int):
-    try:
-        supabase_request('DELETE', 'user_states', params={'user_id': f'eq.{user_id}'})
-    except Exception as e:
-        print(f"❌ Ошибка очистки состояния: {e}")
-
+    # --- 📉 Decrease balance ---
+    tasks_left = decrease_user_tasks(ctx)
+    return {'queue_id': queue_item['id'], 'tasks_left': tasks_left if tasks_left is not None else 0}
 
 # ============= Commands handler =============
-def handle_start(chat_id: int, user_id: int):
+def handle_start(ctx: UpdateContext):
 
     
     welcome_text = """👋 <b>Привет! Я бот для подготовки к олимпиадам!</b>
@@ -287,25 +409,25 @@ def handle_start(chat_id: int, user_id: int):
 
 Готов начать? Жми на кнопку! 🚀"""
     
-    send_telegram_message(chat_id, welcome_text, reply_markup=get_main_keyboard())
+    send_telegram_message(ctx.chat_id, welcome_text, reply_markup=get_main_keyboard())
 
-def handle_get_task_menu(chat_id: int, user_id: int):
+def handle_get_task_menu(ctx: UpdateContext):
     """Shows the category selection menu"""
-    categories = get_categories()
-    if not categories:
-        handle_get_task_execution(chat_id, user_id, category=None)
+    index = get_category_index()
+    if not index['categories']:
+        handle_get_task_execution(ctx, category=None)
         return
 
     msg = "Выберите категорию заданий:"
-    send_telegram_message(chat_id, msg, reply_markup=get_categories_keyboard(categories))
+    send_telegram_message(ctx.chat_id, msg, reply_markup=index['keyboard'])
     # Set state to expect category selection
-    set_user_state(user_id, 'waiting_for_category')
+    ctx.set_state('waiting_for_category')
 
-def handle_get_task_execution(chat_id: int, user_id: int, category: Optional[str]):
+def handle_get_task_execution(ctx: UpdateContext, category: Optional[str]):
+    chat_id = ctx.chat_id
 
     # --- 💰 Balance check :)
-    user_db = get_or_create_user(user_id)
-    tasks_left = user_db.get('tasks_left', 0)
+    tasks_left = ctx.user.get('tasks_left', 0)
     
     if tasks_left <= 0:
         send_telegram_message(
@@ -314,20 +436,23 @@ def handle_get_task_execution(chat_id: int, user_id: int, category: Optional[str
             "На вашем балансе 0 попыток.",
             reply_markup=get_main_keyboard()
         )
-        clear_user_state(user_id)
+        ctx.clear_state()
         return
-    task = get_random_task(user_id, category)
+    task = get_random_task(ctx.user_id, category, ctx.user.get('stats_reset_at'))
     
     if not task:
         msg = "🎉 Вы решили все задачи в этой категории на максимум!"
         if category:
             msg += "\nПопробуйте другую категорию или сбросьте рейтинг."
         send_telegram_message(chat_id, msg, reply_markup=get_main_keyboard())
-        clear_user_state(user_id) # Reset state so they aren't stuck
+        ctx.clear_state() # Reset state so they aren't stuck
         return
 
    
-    set_user_state(user_id, 'waiting_for_answer', {'task': task})
+    # Only the id and a compact projection go into the state; the full row
+    # stays in the local task cache.
+    task_cache.remember(task)
+    ctx.set_state('waiting_for_answer', {'task_id': task['id'], 'task': task_cache.compact(task)})
     
     task_text = f"📝 Задание ({task.get('category', 'Общее')}):\n{task['text']}\n\nНапиши свой развернутый ответ."
     send_telegram_message(chat_id, task_text, reply_markup=get_main_keyboard()) 
@@ -336,8 +461,15 @@ def handle_get_task_execution(chat_id: int, user_id: int, category: Optional[str
 
 
 
-def handle_answer(chat_id: int, user_id: int, answer_text: str):
-    state = get_user_state(user_id)
+def state_task_id(state: Dict) -> int:
+    # States written before task_id was introduced hold the whole task row.
+    data = state['data']
+    return data['task_id'] if 'task_id' in data else data['task']['id']
+
+
+def handle_answer(ctx: UpdateContext, answer_text: str):
+    chat_id = ctx.chat_id
+    state = ctx.state
     if not state or state['state'] != 'waiting_for_answer':
         send_telegram_message(
             chat_id,
@@ -347,8 +479,7 @@ def handle_answer(chat_id: int, user_id: int, answer_text: str):
         return
 
     
-    user_db = get_or_create_user(user_id)
-    tasks_left = user_db.get('tasks_left', 0)
+    tasks_left = ctx.user.get('tasks_left', 0)
     
     if tasks_left <= 0:
         send_telegram_message(
@@ -357,28 +488,32 @@ def handle_answer(chat_id: int, user_id: int, answer_text: str):
             "Ваша подписка исчерпана. Пожалуйста, пополните баланс, чтобы продолжить обучение.",
             reply_markup=get_main_keyboard()
         )
-        clear_user_state(user_id) 
+        ctx.clear_state() 
         return
 
-    task = state['data']['task']
+    task_id = state_task_id(state)
     
-    queue_item = add_to_processing_queue(
-        chat_id=chat_id,
-        user_id=user_id,
-        task_id=task['id'],
-        user_answer=answer_text
-    )
+    result = submit_answer(ctx, task_id, answer_text)
     
-    if queue_item:
-        # --- 📉 Decrease balance ---
-        decrease_user_tasks(user_id)
-        # -------------------
-        
+    if result and result.get('queue_id') is not None:
         send_telegram_message(
             chat_id,
-            f"⏳ Твой ответ принят! Осталось попыток: <b>{tasks_left - 1}</b>.\n"
+            f"⏳ Твой ответ принят! Осталось попыток: <b>{result['tasks_left']}</b>.\n"
             "Проверяю... Результат придёт в течение пары минут."
         )
+        # After the reply is sent, so the user is not kept waiting for the push
+        # (the reply then goes out as a request, not in the webhook response).
+        if WORKER_WAKEUP_URL:
+            queue_id = result['queue_id']
+            telegram_sender.after_send(lambda: wake_worker([queue_id]))
+    elif result:
+        # Balance ran out between the check above and the submission.
+        send_telegram_message(
+            chat_id,
+            "💳 <b>Закончились доступные проверки.</b>\n\n"
+            "Ваша подписка исчерпана. Пожалуйста, пополните баланс, чтобы продолжить обучение.",
+            reply_markup=get_main_keyboard()
+        )
     else:
         send_telegram_message(
             chat_id,
@@ -386,13 +521,69 @@ def handle_answer(chat_id: int, user_id: int, answer_text: str):
             reply_markup=get_main_keyboard()
         )
     
-    clear_user_state(user_id)
-
-def handle_statistics(chat_id: int, user_id: int):
+    ctx.clear_state()
+
+# ============= Statistics =============
+# user_stats (sql/009_user_stats.sql) is kept up to date by the worker, so
+# statistics are one small row. Without the table the history is read.
+STATS_COLUMNS = 'attempts,percent_sum,best_percent,by_category'
+_stats_table_retry_at = 0.0
+
+
+def load_user_stats(user_id: int, since: Optional[str] = None) -> Optional[Dict]:
+    """The user's aggregate row ({} if there is none yet), None if it could not be read."""
+    global _stats_table_retry_at
+    if time.monotonic() >= _stats_table_retry_at:
+        rows = supabase_request('GET', 'user_stats', params={'user_id': f'eq.{user_id}', 'select': STATS_COLUMNS})
+        if rows is not None:
+            return rows[0] if rows else {}
+        print("⚠️ user_stats unavailable, reading attempts")
+        _stats_table_retry_at = time.monotonic() + RPC_RETRY_SECONDS
+    return load_user_stats_from_attempts(user_id, since)
+
+
+def load_user_stats_from_attempts(user_id: int, since: Optional[str] = None) -> Optional[Dict]:
+    # Fallback: two columns of the history since the last reset, no per-category breakdown.
+    params = {'user_id': f'eq.{user_id}', 'select': 'score,max_score'}
+    if since:
+        params['created_at'] = f'gt.{since}'
+    attempts = supabase_request('GET', 'attempts', params=params)
+    if attempts is None:
+        return None
+    if not attempts:
+        return {}
+    percents = [round(a['score'] / a['max_score'] * 100) for a in attempts
+                if a.get('score') is not None and a.get('max_score')]
+    return {'attempts': len(attempts), 'percent_sum': sum(percents),
+            'best_percent': max(percents, default=0), 'by_category': {}}
+
+
+def format_statistics(stats: Dict) -> str:
+    avg_score = round(stats['percent_sum'] / stats['attempts'])
+    lines = [
+        "📊 <b>Твоя статистика:</b>",
+        f"📝 Попыток решений: {stats['attempts']}",
+        f"⭐️ Средний процент решения: {avg_score}%",
+        f"🎯 Лучший результат: {stats['best_percent']}%",
+    ]
+    by_category = stats.get('by_category') or {}
+    if by_category:
+        lines.append("\n📂 <b>По категориям:</b>")
+        for category, c in sorted(by_category.items()):
+            lines.append(f"• {category or 'Без категории'}: {c['attempts']} попыт., "
+                         f"в среднем {round(c['percent_sum'] / c['attempts'])}%, лучший {c['best_percent']}%")
+    lines.append("\nПродолжай в том же духе! 🚀")
+    return "\n".join(lines)
+
+
+def handle_statistics(ctx: UpdateContext):
+    chat_id = ctx.chat_id
     try:
-        attempts = supabase_request('GET', 'attempts', params={'user_id': f'eq.{user_id}'})
-        
-        if not attempts or len(attempts) == 0:
+        stats = load_user_stats(ctx.user_id, ctx.user.get('stats_reset_at'))
+        if stats is None:
+            raise RuntimeError("statistics unavailable")
+
+        if not stats.get('attempts'):
             send_telegram_message(
                 chat_id,
                 "📊 У тебя пока нет решенных заданий. Начни тренировку!",
@@ -400,15 +591,7 @@ def handle_statistics(chat_id: int, user_id: int):
             )
             return
         
-        total_attempts = len(attempts)
-        scores = [round(a['score']/a['max_score']*100) for a in attempts if a.get('score') is not None]
-        avg_score = sum(scores) / len(scores) if scores else 0
-        
-        best_score = max(scores) if scores else 0
-        
-        stats_text = f"📊 <b>Твоя статистика:</b>\n📝 Попыток решений: {total_attempts}\n⭐️ Средний процент решения: {avg_score}%\n🎯 Лучший результат: {best_score}%\n\nПродолжай в том же духе! 🚀"
-        
-        send_telegram_message(chat_id, stats_text, reply_markup=get_main_keyboard())
+        send_telegram_message(chat_id, format_statistics(stats), reply_markup=get_main_keyboard())
         
     except Exception as e:
         print(f"❌ Ошибка получения статистики: {e}")
@@ -440,54 +623,84 @@ def process_update(update: Dict):
         )
         return
 
+    ctx = UpdateContext(chat_id=chat_id, user_id=user_id, username=username, user=user_db)
 
     if text == '/start':
-        handle_start(chat_id, user_id)
+        handle_start(ctx)
         return
     elif text == '📝 Получить задание':
-        handle_get_task_menu(chat_id, user_id)
+        handle_get_task_menu(ctx)
         return
     elif text == '📊 Моя статистика':
-        handle_statistics(chat_id, user_id)
+        handle_statistics(ctx)
         return
     elif text == '🔄 Сбросить рейтинг':
-        handle_reset_statistics(chat_id, user_id)
+        handle_reset_statistics(ctx)
         return
     elif text == '⬅️ Назад в меню':
         send_telegram_message(chat_id, "Главное меню", reply_markup=get_main_keyboard())
-        clear_user_state(user_id)
+        ctx.clear_state()
         return
 
-    state = get_user_state(user_id)
+    state = ctx.state
     
     if state:
         if state['state'] == 'waiting_for_category':
             if text == '🎲 Все категории':
-                handle_get_task_execution(chat_id, user_id, category='all')
+                handle_get_task_execution(ctx, category='all')
             elif text.startswith('📂 '):
                 category = text.replace('📂 ', '')
-                handle_get_task_execution(chat_id, user_id, category=category)
+                handle_get_task_execution(ctx, category=category)
             else:
                 send_telegram_message(chat_id, "Пожалуйста, выберите категорию из меню.")
             return
 
         elif state['state'] == 'waiting_for_answer':
-            handle_answer(chat_id, user_id, text)
+            handle_answer(ctx, text)
             return
 
    
     send_telegram_message(chat_id, "Используйте меню для управления.", reply_markup=get_main_keyboard())
 
-def handle_reset_statistics(chat_id: int, user_id: int):
+def reset_progress(user_id: int) -> Optional[int]:
+    """Starts a new statistics epoch; returns a positive number if there was
+    anything to reset (the RPC gives the attempts count), 0 if not, None on error.
+
+    reset_user_progress (sql/011_reset_epoch.sql) only moves users.stats_reset_at
+    and clears the small aggregates, the attempts history is kept. Without
+    the function the history is deleted as before.
+    """
+    global _reset_rpc_retry_at
+    if time.monotonic() >= _reset_rpc_retry_at:
+        try:
+            result = supabase_rpc('reset_user_progress', {'p_user_id': user_id})
+            return None if result is None else result['previous_attempts']
+        except RpcUnavailable:
+            _reset_rpc_retry_at = time.monotonic() + RPC_RETRY_SECONDS
+
+    attempts = supabase_request('GET', 'attempts', params={'user_id': f'eq.{user_id}', 'select': 'id', 'limit': '1'})
+    if attempts is None:
+        return None
+    if not attempts:
+        return 0
+
+    delete_params = {'user_id': f'eq.{user_id}'}
+    supabase_request('DELETE', 'attempts', params=delete_params)
+    supabase_request('DELETE', 'user_stats', params=delete_params, prefer='return=minimal')
+    supabase_request('DELETE', 'solved_tasks', params=delete_params, prefer='return=minimal')
+    return len(attempts)
+
+
+def handle_reset_statistics(ctx: UpdateContext):
+    chat_id, user_id = ctx.chat_id, ctx.user_id
     try:
-        attempts = supabase_request('GET', 'attempts', params={'user_id': f'eq.{user_id}', 'select': 'id', 'limit': '1'})
+        previous_attempts = reset_progress(user_id)
+        if previous_attempts is None:
+            raise RuntimeError("reset failed")
         
-        if not attempts:
+        if not previous_attempts:
              send_telegram_message(chat_id, "У вас нет решенных задач для сброса.", reply_markup=get_main_keyboard())
              return
-
-        delete_params = {'user_id': f'eq.{user_id}'}
-        supabase_request('DELETE', 'attempts', params=delete_params)
         
         send_telegram_message(chat_id, "🔄 Статистика полностью сброшена. Все задачи снова доступны!", reply_markup=get_main_keyboard())
         
@@ -497,6 +710,8 @@ def handle_reset_statistics(chat_id: int, user_id: int):
 
 # ============= CLOUD FUNCTION HANDLER =============
 def handler(event, context):
+    tracing.start_invocation()
+    outbox = None
 
     try:
         if isinstance(event.get('body'), str):
@@ -504,9 +719,21 @@ def handler(event, context):
         else:
             body = event.get('body', {})
         
+        reply = None
         if body:
-            process_update(body)
+            with telegram_sender.collect() as outbox:
+                process_update(body)
+            reply = outbox.webhook_reply() if TELEGRAM_WEBHOOK_REPLY else None
+            outbox.flush()
         
+        tracing.emit('handler', webhook_reply=reply is not None)
+        if reply:
+            # Telegram performs the method from the webhook response itself.
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps(reply)
+            }
         return {
             'statusCode': 200,
             'body': json.dumps({'status': 'ok'})
@@ -516,6 +743,9 @@ def handler(event, context):
         print(f"❌ Критическая ошибка в handler: {e}")
         import traceback
         traceback.print_exc()
+        if outbox is not None:
+            outbox.flush()
+        tracing.emit('handler', error=str(e))
         
         return {
             'statusCode': 500,
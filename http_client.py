@@ -0,0 +1,167 @@
+import os
+from typing import TYPE_CHECKING, Optional, Dict, Any
+from urllib.parse import urlsplit
+
+import tracing
+
+# requests (and urllib3 under it) is imported with the first session, so
+# importing this module for its configuration stays cheap.
+if TYPE_CHECKING:
+    import requests
+
+# ========= Configuration =============
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
+SUPABASE_URL = os.environ.get('SUPABASE_URL')
+SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '10'))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '3'))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', '0.3'))
+
+# The session lives at module level so warm containers keep their
+# TCP/TLS connections between invocations.
+_session: "Optional[requests.Session]" = None
+
+
+def get_session() -> "requests.Session":
+    global _session
+    if _session is None:
+        import requests
+        import urllib3
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        retry = Retry(
+            total=HTTP_RETRIES,
+            backoff_factor=HTTP_BACKOFF,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # Only idempotent methods are retried, a repeated POST could
+            # enqueue the same answer twice.
+            allowed_methods=frozenset({'GET', 'HEAD', 'DELETE', 'OPTIONS'}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        # pool_block makes the pool size a per-host concurrency limit, so a
+        # thread pool in the worker cannot open unbounded connections.
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                              max_retries=retry, pool_block=True)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session = session
+    return _session
+
+
+def request(method: str, url: str, **kwargs) -> "requests.Response":
+    """Sends a request through the shared session (timed by the callers' spans)."""
+    return get_session().request(method, url, **kwargs)
+
+
+# ============= SUPABASE API =============
+def supabase_request(method: str, table: str, data: Optional[Any] = None, params: Optional[Dict] = None,
+                     prefer: str = 'return=representation') -> Any:
+    url = f"{SUPABASE_URL}/rest/v1/{table}"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Content-Type': 'application/json',
+        'Prefer': prefer
+    }
+
+    if method not in ('GET', 'POST', 'PATCH', 'DELETE'):
+        raise ValueError(f"Неподдерживаемый метод: {method}")
+
+    with tracing.span('supabase', f"{method} {table}") as span:
+        try:
+            response = request(method, url, headers=headers, params=params,
+                               json=data if method in ('POST', 'PATCH') else None, timeout=10)
+
+            # DELETE might return 204 No Content, which has no JSON.
+            if response.status_code == 204:
+                return None
+
+            response.raise_for_status()
+            # return=minimal writes succeed with an empty body.
+            if not response.content:
+                return []
+            return response.json()
+
+        except Exception as e:
+            span.error = True
+            print(f"❌ Ошибка Supabase запроса: {method} {url} with params {params} -> {e}")
+            return None
+
+
+class RpcUnavailable(Exception):
+    """The database function is not deployed (PostgREST answered 404)."""
+
+
+def supabase_rpc(function: str, args: Dict) -> Any:
+    """Calls a Postgres function through /rpc.
+
+    Raises RpcUnavailable when the function does not exist, so callers can
+    switch to their fallback path; other errors are logged and give None.
+    """
+    url = f"{SUPABASE_URL}/rest/v1/rpc/{function}"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Content-Type': 'application/json',
+    }
+    with tracing.span('supabase', f"RPC {function}") as span:
+        try:
+            response = request('POST', url, headers=headers, json=args, timeout=10)
+        except Exception as e:
+            span.error = True
+            print(f"❌ Ошибка Supabase RPC: {function} -> {e}")
+            return None
+        if response.status_code == 404:
+            raise RpcUnavailable(function)
+        if response.status_code == 204:
+            return None
+        try:
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            span.error = True
+            print(f"❌ Ошибка Supabase RPC: {function} -> {e}")
+            return None
+
+
+# ============= TELEGRAM API =============
+def telegram_request(api_method: str, payload: Dict, timeout: float = 5) -> Dict:
+    """Calls a Bot API method. Errors are raised, callers decide how to handle them."""
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/{api_method}"
+    # A long poll waits for updates by design; it would swamp the telegram percentiles.
+    with tracing.span('telegram_poll' if api_method == 'getUpdates' else 'telegram', api_method):
+        response = request('POST', url, json=payload, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+
+# ============= Fire-and-forget =============
+def notify_url(url: str, payload: Dict, timeout: float = 0.5, headers: Optional[Dict] = None) -> bool:
+    """POSTs payload without waiting for the receiver to finish.
+
+    A read timeout still counts as delivered: the request went out, only
+    the (possibly long) processing on the other side was not awaited.
+    """
+    from requests.exceptions import ReadTimeout
+
+    host = urlsplit(url).netloc
+    with tracing.span('wakeup', host) as span:
+        try:
+            response = request('POST', url, json=payload, headers=headers, timeout=(timeout, timeout))
+            if response.status_code >= 400:
+                span.error = True
+                print(f"⚠️ {host} answered {response.status_code}")
+                return False
+            return True
+        except ReadTimeout:
+            return True
+        except Exception as e:
+            span.error = True
+            print(f"⚠️ Request to {host} failed: {e}")
+            return False
@@ -0,0 +1,156 @@
+"""Long-polling runner for self-hosted deployments.
+
+Instead of one function invocation per webhook update, a single process
+polls getUpdates and runs handler.process_update in a thread pool. Updates
+of different users are processed concurrently, updates of the same user
+strictly in order. All handler logic, module caches and the HTTP connection
+pool are shared with the webhook path (and stay warm for the whole run).
+
+    python runner.py [--delete-webhook]
+"""
+import argparse
+import asyncio
+import contextvars
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Set
+
+import handler
+import state_store
+import telegram_sender
+import tracing
+from http_client import telegram_request
+
+RUNNER_CONCURRENCY = int(os.environ.get('RUNNER_CONCURRENCY', '8'))
+# Seconds Telegram holds a getUpdates request open when there is nothing new.
+RUNNER_POLL_TIMEOUT = int(os.environ.get('RUNNER_POLL_TIMEOUT', '25'))
+# Updates taken but not processed yet; polling pauses above this number.
+RUNNER_MAX_PENDING = int(os.environ.get('RUNNER_MAX_PENDING', '200'))
+MAX_BACKOFF_SECONDS = 30
+# Every update goes through this one process, so cached dialog states cannot go stale.
+state_store.STATE_CACHE_TTL = float(os.environ.get('STATE_CACHE_TTL', '30'))
+# Updates run concurrently here, so the trace summary covers an interval rather than one update.
+RUNNER_TRACE_SECONDS = float(os.environ.get('RUNNER_TRACE_SECONDS', '60'))
+
+
+def handle_update(update: Dict):
+    # No webhook response to reply in: queued messages are sent right after the update.
+    with telegram_sender.collect() as outbox:
+        try:
+            handler.process_update(update)
+        finally:
+            outbox.flush()
+
+
+def update_key(update: Dict):
+    """Updates with the same key are processed one after another."""
+    for kind in ('message', 'edited_message', 'callback_query'):
+        if kind in update:
+            sender = update[kind].get('from') or update[kind].get('chat') or {}
+            return sender.get('id')
+    return None
+
+
+class Runner:
+    def __init__(self, concurrency: int = RUNNER_CONCURRENCY, poll_timeout: int = RUNNER_POLL_TIMEOUT,
+                 max_pending: int = RUNNER_MAX_PENDING):
+        self.poll_timeout = poll_timeout
+        self.max_pending = max_pending
+        self.offset: Optional[int] = None
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='update')
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tails: Dict[object, asyncio.Task] = {}
+        self._pending: Set[asyncio.Task] = set()
+
+    # --- Dispatch ---
+    def dispatch(self, update: Dict) -> asyncio.Task:
+        key = update_key(update)
+        task = asyncio.create_task(self._process(update, self._tails.get(key)))
+        self._tails[key] = task
+        self._pending.add(task)
+
+        def done(t):
+            self._pending.discard(t)
+            if self._tails.get(key) is t:
+                del self._tails[key]
+        task.add_done_callback(done)
+        return task
+
+    async def _process(self, update: Dict, previous: Optional[asyncio.Task]):
+        if previous is not None:
+            # A failed previous update must not block the user's next one.
+            await asyncio.wait([previous])
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            try:
+                # The task's context carries the trace window the update is counted in.
+                await loop.run_in_executor(self._executor, contextvars.copy_context().run, handle_update, update)
+            except Exception as e:
+                print(f"❌ Ошибка обработки обновления {update.get('update_id')}: {e}")
+
+    # --- Polling ---
+    async def poll_once(self) -> int:
+        payload = {'timeout': self.poll_timeout, 'allowed_updates': ['message']}
+        if self.offset is not None:
+            payload['offset'] = self.offset
+        response = await asyncio.to_thread(telegram_request, 'getUpdates', payload, self.poll_timeout + 10)
+        updates = response.get('result') or []
+        for update in updates:
+            # The next getUpdates with this offset confirms the update to Telegram.
+            self.offset = update['update_id'] + 1
+            self.dispatch(update)
+        return len(updates)
+
+    async def run(self, stop: Optional[asyncio.Event] = None):
+        stop = stop or asyncio.Event()
+        backoff = 1
+        # One window for the whole process, restarted in place so updates still running are counted in the next one.
+        window = tracing.start_invocation()
+        trace_at = time.monotonic() + RUNNER_TRACE_SECONDS
+        while not stop.is_set():
+            if time.monotonic() >= trace_at:
+                tracing.emit('runner', pending=len(self._pending))
+                window.restart()
+                trace_at = time.monotonic() + RUNNER_TRACE_SECONDS
+            while len(self._pending) >= self.max_pending:
+                await asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED)
+            try:
+                await self.poll_once()
+                backoff = 1
+            except Exception as e:
+                print(f"⚠️ getUpdates failed, retrying in {backoff}s: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF_SECONDS)
+        await self.drain()
+
+    async def drain(self):
+        """Waits until every taken update is processed."""
+        while self._pending:
+            await asyncio.wait(list(self._pending))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+async def main_async(delete_webhook: bool):
+    if delete_webhook:
+        # getUpdates answers 409 while a webhook is set.
+        telegram_request('deleteWebhook', {'drop_pending_updates': False})
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    runner = Runner()
+    print(f"Polling for updates (concurrency {RUNNER_CONCURRENCY})...")
+    try:
+        await runner.run(stop)
+    finally:
+        runner.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Long-polling runner for the bot")
+    parser.add_argument('--delete-webhook', action='store_true', help='remove the webhook before polling')
+    asyncio.run(main_async(parser.parse_args().delete_webhook))
@@ -0,0 +1,26 @@
+-- Server-side task selection for handler.get_random_task.
+-- Returns one random task the user has not solved on max score yet,
+-- only with the columns the bot shows to the user.
+
+create index if not exists attempts_user_task_idx on attempts (user_id, task_id);
+create index if not exists tasks_category_idx on tasks (category);
+
+create or replace function pick_random_task(p_user_id bigint, p_category text default null)
+returns table (id bigint, category text, text text, max_score numeric)
+language sql
+stable
+as $$
+    select t.id::bigint, t.category::text, t.text::text, t.max_score::numeric
+    from tasks t
+    where (p_category is null or t.category = p_category)
+      and not exists (
+          select 1
+          from attempts a
+          where a.user_id = p_user_id
+            and a.task_id = t.id
+            and a.max_score > 0
+            and a.score >= a.max_score - 0.1
+      )
+    order by random()
+    limit 1;
+$$;
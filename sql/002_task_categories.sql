@@ -0,0 +1,7 @@
+-- Distinct task categories with counts for handler.get_category_index.
+
+create or replace view task_categories as
+select category, count(*)::int as task_count
+from tasks
+where category is not null
+group by category;
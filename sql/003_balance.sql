@@ -0,0 +1,43 @@
+-- Atomic balance operations for handler.decrease_user_tasks / handler.submit_answer.
+
+-- Takes one attempt from the balance. Returns the new balance, or null when
+-- the balance is already exhausted.
+create or replace function decrement_tasks_left(p_user_id bigint)
+returns integer
+language sql
+volatile
+as $$
+    update users
+    set tasks_left = tasks_left - 1
+    where user_id = p_user_id and tasks_left > 0
+    returning tasks_left;
+$$;
+
+-- Balance check, decrement and queue insert in one transaction.
+-- Returns {"queue_id": ..., "tasks_left": ...}; queue_id is null when the
+-- balance is exhausted and nothing was enqueued.
+create or replace function submit_answer(p_chat_id bigint, p_user_id bigint, p_task_id bigint, p_answer text)
+returns json
+language plpgsql
+volatile
+as $$
+declare
+    v_tasks_left integer;
+    v_queue_id bigint;
+begin
+    update users
+    set tasks_left = tasks_left - 1
+    where user_id = p_user_id and tasks_left > 0
+    returning tasks_left into v_tasks_left;
+
+    if v_tasks_left is null then
+        return json_build_object('queue_id', null, 'tasks_left', 0);
+    end if;
+
+    insert into processing_queue (chat_id, user_id, task_id, user_answer_text, status, created_at)
+    values (p_chat_id, p_user_id, p_task_id, p_answer, 'pending', now())
+    returning id into v_queue_id;
+
+    return json_build_object('queue_id', v_queue_id, 'tasks_left', v_tasks_left);
+end;
+$$;
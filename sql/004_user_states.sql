@@ -0,0 +1,4 @@
+-- state_store.set_state writes with one upsert (on_conflict=user_id),
+-- which needs a unique constraint on user_states.user_id.
+
+create unique index if not exists user_states_user_id_key on user_states (user_id);
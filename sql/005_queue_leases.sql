@@ -0,0 +1,29 @@
+-- Leases for processing_queue so several workers can drain it in parallel.
+-- A claimed row is 'processing' with an owner and an expiry; rows whose
+-- lease expired (the worker died or timed out) are claimed again.
+
+alter table processing_queue add column if not exists lease_owner text;
+alter table processing_queue add column if not exists lease_expires_at timestamptz;
+
+create index if not exists processing_queue_status_created_idx on processing_queue (status, created_at);
+
+create or replace function claim_queue_items(p_owner text, p_limit integer, p_lease_seconds integer default 120)
+returns setof processing_queue
+language sql
+volatile
+as $$
+    update processing_queue q
+    set status = 'processing',
+        lease_owner = p_owner,
+        lease_expires_at = now() + make_interval(secs => p_lease_seconds)
+    where q.id in (
+        select id
+        from processing_queue
+        where status = 'pending'
+           or (status = 'processing' and lease_expires_at < now())
+        order by created_at
+        limit p_limit
+        for update skip locked
+    )
+    returning q.*;
+$$;
@@ -0,0 +1,19 @@
+-- Version column for task_cache: bumped on every change of a task, so warm
+-- caches revalidate expired rows with a tiny id,updated_at request.
+
+alter table tasks add column if not exists updated_at timestamptz not null default now();
+
+create or replace function touch_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.updated_at = now();
+    return new;
+end;
+$$;
+
+drop trigger if exists tasks_touch_updated_at on tasks;
+create trigger tasks_touch_updated_at
+    before update on tasks
+    for each row execute function touch_updated_at();
@@ -0,0 +1,16 @@
+-- Grades reused by the worker for identical answers (grading_cache.py).
+-- key_version changes with the task's answer key / max score, answer_hash is
+-- sha256 of the normalized answer.
+
+create table if not exists grading_cache (
+    task_id bigint not null,
+    key_version text not null,
+    answer_hash text not null,
+    score numeric not null,
+    max_score numeric not null,
+    comment text,
+    created_at timestamptz not null default now(),
+    primary key (task_id, key_version, answer_hash)
+);
+
+create index if not exists grading_cache_answer_hash_idx on grading_cache (answer_hash);
@@ -0,0 +1,31 @@
+-- Wake-up runs of the worker claim only the queue ids they were sent.
+-- p_ids is null for timer (sweeper) runs, which claim anything claimable.
+
+drop function if exists claim_queue_items(text, integer, integer);
+
+create or replace function claim_queue_items(
+    p_owner text,
+    p_limit integer,
+    p_lease_seconds integer default 120,
+    p_ids bigint[] default null
+)
+returns setof processing_queue
+language sql
+volatile
+as $$
+    update processing_queue q
+    set status = 'processing',
+        lease_owner = p_owner,
+        lease_expires_at = now() + make_interval(secs => p_lease_seconds)
+    where q.id in (
+        select id
+        from processing_queue
+        where (status = 'pending'
+               or (status = 'processing' and lease_expires_at < now()))
+          and (p_ids is null or id = any(p_ids))
+        order by created_at
+        limit p_limit
+        for update skip locked
+    )
+    returning q.*;
+$$;
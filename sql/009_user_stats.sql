@@ -0,0 +1,84 @@
+-- Per-user statistics maintained by the worker (record_attempt_stats) so the
+-- bot reads one small row instead of the whole attempts history.
+-- percent is round(score / max_score * 100) of one attempt; by_category holds
+-- {"<category>": {"attempts": n, "percent_sum": s, "best_percent": b}}.
+
+create table if not exists user_stats (
+    user_id bigint primary key,
+    attempts integer not null default 0,
+    percent_sum bigint not null default 0,
+    best_percent integer not null default 0,
+    by_category jsonb not null default '{}'::jsonb,
+    updated_at timestamptz not null default now()
+);
+
+-- p_rows: [{"user_id": ..., "category": ..., "percent": ...}, ...], one per stored attempt.
+-- Returns the number of recorded attempts.
+create or replace function record_attempt_stats(p_rows jsonb)
+returns integer
+language plpgsql
+volatile
+as $$
+declare
+    r record;
+begin
+    -- Ordered by user so concurrent workers lock user_stats rows in the same order.
+    for r in
+        select (e->>'user_id')::bigint as user_id,
+               coalesce(e->>'category', '') as category,
+               (e->>'percent')::integer as percent
+        from jsonb_array_elements(p_rows) e
+        order by 1
+    loop
+        insert into user_stats as s (user_id, attempts, percent_sum, best_percent, by_category)
+        values (r.user_id, 1, r.percent, r.percent,
+                jsonb_build_object(r.category, jsonb_build_object(
+                    'attempts', 1, 'percent_sum', r.percent, 'best_percent', r.percent)))
+        on conflict (user_id) do update
+        set attempts = s.attempts + 1,
+            percent_sum = s.percent_sum + r.percent,
+            best_percent = greatest(s.best_percent, r.percent),
+            by_category = s.by_category || jsonb_build_object(r.category, jsonb_build_object(
+                'attempts', coalesce((s.by_category->r.category->>'attempts')::integer, 0) + 1,
+                'percent_sum', coalesce((s.by_category->r.category->>'percent_sum')::bigint, 0) + r.percent,
+                'best_percent', greatest(coalesce((s.by_category->r.category->>'best_percent')::integer, 0), r.percent))),
+            updated_at = now();
+    end loop;
+    return jsonb_array_length(p_rows);
+end;
+$$;
+
+-- Recomputes user_stats from attempts, for one user or (p_user_id null) for everyone.
+create or replace function rebuild_user_stats(p_user_id bigint default null)
+returns void
+language sql
+volatile
+as $$
+    delete from user_stats where p_user_id is null or user_id = p_user_id;
+
+    with graded as (
+        select a.user_id,
+               coalesce(t.category, '') as category,
+               round(a.score / a.max_score * 100)::integer as percent
+        from attempts a
+        left join tasks t on t.id = a.task_id
+        where a.score is not null and a.max_score > 0
+          and (p_user_id is null or a.user_id = p_user_id)
+    ),
+    per_category as (
+        select user_id, category, count(*) as attempts, sum(percent) as percent_sum, max(percent) as best_percent
+        from graded
+        group by user_id, category
+    )
+    insert into user_stats (user_id, attempts, percent_sum, best_percent, by_category)
+    select user_id,
+           sum(attempts)::integer,
+           sum(percent_sum)::bigint,
+           max(best_percent)::integer,
+           jsonb_object_agg(category, jsonb_build_object(
+               'attempts', attempts, 'percent_sum', percent_sum, 'best_percent', best_percent))
+    from per_category
+    group by user_id;
+$$;
+
+select rebuild_user_stats();
@@ -0,0 +1,33 @@
+-- Tasks each user has solved on (almost) max score, maintained by the worker.
+-- Task selection checks this set instead of rescanning the attempts history.
+
+create table if not exists solved_tasks (
+    user_id bigint not null,
+    task_id bigint not null,
+    solved_at timestamptz not null default now(),
+    primary key (user_id, task_id)
+);
+
+insert into solved_tasks (user_id, task_id)
+select distinct user_id, task_id
+from attempts
+where max_score > 0 and score >= max_score - 0.1
+on conflict do nothing;
+
+create or replace function pick_random_task(p_user_id bigint, p_category text default null)
+returns table (id bigint, category text, text text, max_score numeric)
+language sql
+stable
+as $$
+    select t.id::bigint, t.category::text, t.text::text, t.max_score::numeric
+    from tasks t
+    where (p_category is null or t.category = p_category)
+      and not exists (
+          select 1
+          from solved_tasks s
+          where s.user_id = p_user_id
+            and s.task_id = t.id
+      )
+    order by random()
+    limit 1;
+$$;
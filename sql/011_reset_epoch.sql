@@ -0,0 +1,89 @@
+-- Resetting progress records an epoch instead of deleting the history.
+-- Attempts older than users.stats_reset_at are ignored by statistics and
+-- task selection; they stay in attempts for analytics until purged.
+
+alter table users add column if not exists stats_reset_at timestamptz;
+alter table attempts add column if not exists created_at timestamptz not null default now();
+
+create index if not exists attempts_user_created_idx on attempts (user_id, created_at);
+
+-- Returns {"previous_attempts": n}; n = 0 means there was nothing to reset.
+create or replace function reset_user_progress(p_user_id bigint)
+returns json
+language plpgsql
+volatile
+as $$
+declare
+    v_previous integer;
+begin
+    select coalesce((select attempts from user_stats where user_id = p_user_id), 0) into v_previous;
+    if v_previous = 0 then
+        return json_build_object('previous_attempts', 0);
+    end if;
+
+    update users set stats_reset_at = now() where user_id = p_user_id;
+    delete from user_stats where user_id = p_user_id;
+    delete from solved_tasks where user_id = p_user_id;
+    return json_build_object('previous_attempts', v_previous);
+end;
+$$;
+
+-- Same as in 009, but only attempts of the current epoch are counted.
+create or replace function rebuild_user_stats(p_user_id bigint default null)
+returns void
+language sql
+volatile
+as $$
+    delete from user_stats where p_user_id is null or user_id = p_user_id;
+
+    with graded as (
+        select a.user_id,
+               coalesce(t.category, '') as category,
+               round(a.score / a.max_score * 100)::integer as percent
+        from attempts a
+        left join tasks t on t.id = a.task_id
+        left join users u on u.user_id = a.user_id
+        where a.score is not null and a.max_score > 0
+          and (u.stats_reset_at is null or a.created_at > u.stats_reset_at)
+          and (p_user_id is null or a.user_id = p_user_id)
+    ),
+    per_category as (
+        select user_id, category, count(*) as attempts, sum(percent) as percent_sum, max(percent) as best_percent
+        from graded
+        group by user_id, category
+    )
+    insert into user_stats (user_id, attempts, percent_sum, best_percent, by_category)
+    select user_id,
+           sum(attempts)::integer,
+           sum(percent_sum)::bigint,
+           max(best_percent)::integer,
+           jsonb_object_agg(category, jsonb_build_object(
+               'attempts', attempts, 'percent_sum', percent_sum, 'best_percent', best_percent))
+    from per_category
+    group by user_id;
+$$;
+
+-- Optional cleanup job (e.g. pg_cron): deletes up to p_limit attempts from
+-- before the owner's last reset. Returns the number of deleted rows; call it
+-- until it returns 0.
+create or replace function purge_reset_attempts(p_limit integer default 10000)
+returns integer
+language plpgsql
+volatile
+as $$
+declare
+    v_deleted integer;
+begin
+    delete from attempts
+    where id in (
+        select a.id
+        from attempts a
+        join users u on u.user_id = a.user_id
+        where u.stats_reset_at is not null
+          and a.created_at <= u.stats_reset_at
+        limit p_limit
+    );
+    get diagnostics v_deleted = row_count;
+    return v_deleted;
+end;
+$$;
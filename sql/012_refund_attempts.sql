@@ -0,0 +1,35 @@
+-- Answers the worker could not grade (status 'error') give the attempt back.
+-- refunded_at makes the refund idempotent: a repeated call for the same
+-- queue item does not add to the balance again.
+
+alter table processing_queue add column if not exists refunded_at timestamptz;
+
+-- Returns the number of refunded queue items.
+create or replace function refund_attempts(p_queue_ids bigint[])
+returns integer
+language plpgsql
+volatile
+as $$
+declare
+    v_refunded integer;
+begin
+    with refunded as (
+        update processing_queue
+        set refunded_at = now()
+        where id = any(p_queue_ids) and status = 'error' and refunded_at is null
+        returning user_id
+    ),
+    per_user as (
+        select user_id, count(*)::integer as n from refunded group by user_id
+    ),
+    credited as (
+        update users u
+        set tasks_left = u.tasks_left + p.n
+        from per_user p
+        where u.user_id = p.user_id
+        returning p.n
+    )
+    select coalesce(sum(n), 0)::integer into v_refunded from credited;
+    return v_refunded;
+end;
+$$;
@@ -0,0 +1,105 @@
+-- Makes the worker's writes safe to repeat. An attempt is keyed by its queue
+-- item, so a retried insert (lost response, re-claimed lease) is ignored
+-- instead of stored twice, and record_attempt_stats counts every attempt
+-- once, however often it is called for it.
+
+alter table attempts add column if not exists queue_id bigint;
+create unique index if not exists attempts_queue_id_key on attempts (queue_id);
+
+do $$
+begin
+    if not exists (select 1 from information_schema.columns
+                   where table_name = 'attempts' and column_name = 'stats_recorded_at') then
+        alter table attempts add column stats_recorded_at timestamptz;
+        -- Existing attempts are already in user_stats (009 rebuilt it).
+        update attempts set stats_recorded_at = created_at;
+    end if;
+end;
+$$;
+
+-- p_rows: [{"queue_id": ..., "user_id": ..., "category": ..., "percent": ...}, ...].
+-- Rows with a queue_id are counted only if that attempt was not counted yet.
+-- Returns the number of recorded attempts.
+create or replace function record_attempt_stats(p_rows jsonb)
+returns integer
+language plpgsql
+volatile
+as $$
+declare
+    r record;
+    v_recorded integer := 0;
+begin
+    -- Ordered by user so concurrent workers lock user_stats rows in the same order.
+    for r in
+        select (e->>'user_id')::bigint as user_id,
+               coalesce(e->>'category', '') as category,
+               (e->>'percent')::integer as percent,
+               (e->>'queue_id')::bigint as queue_id
+        from jsonb_array_elements(p_rows) e
+        order by 1
+    loop
+        if r.queue_id is not null then
+            update attempts set stats_recorded_at = now()
+            where queue_id = r.queue_id and stats_recorded_at is null;
+            if not found then
+                continue;
+            end if;
+        end if;
+
+        insert into user_stats as s (user_id, attempts, percent_sum, best_percent, by_category)
+        values (r.user_id, 1, r.percent, r.percent,
+                jsonb_build_object(r.category, jsonb_build_object(
+                    'attempts', 1, 'percent_sum', r.percent, 'best_percent', r.percent)))
+        on conflict (user_id) do update
+        set attempts = s.attempts + 1,
+            percent_sum = s.percent_sum + r.percent,
+            best_percent = greatest(s.best_percent, r.percent),
+            by_category = s.by_category || jsonb_build_object(r.category, jsonb_build_object(
+                'attempts', coalesce((s.by_category->r.category->>'attempts')::integer, 0) + 1,
+                'percent_sum', coalesce((s.by_category->r.category->>'percent_sum')::bigint, 0) + r.percent,
+                'best_percent', greatest(coalesce((s.by_category->r.category->>'best_percent')::integer, 0), r.percent))),
+            updated_at = now();
+        v_recorded := v_recorded + 1;
+    end loop;
+    return v_recorded;
+end;
+$$;
+
+-- Same as in 011; attempts counted by a rebuild are marked as recorded, so a
+-- late record_attempt_stats call cannot add them a second time.
+create or replace function rebuild_user_stats(p_user_id bigint default null)
+returns void
+language sql
+volatile
+as $$
+    update attempts set stats_recorded_at = now()
+    where stats_recorded_at is null and (p_user_id is null or user_id = p_user_id);
+
+    delete from user_stats where p_user_id is null or user_id = p_user_id;
+
+    with graded as (
+        select a.user_id,
+               coalesce(t.category, '') as category,
+               round(a.score / a.max_score * 100)::integer as percent
+        from attempts a
+        left join tasks t on t.id = a.task_id
+        left join users u on u.user_id = a.user_id
+        where a.score is not null and a.max_score > 0
+          and (u.stats_reset_at is null or a.created_at > u.stats_reset_at)
+          and (p_user_id is null or a.user_id = p_user_id)
+    ),
+    per_category as (
+        select user_id, category, count(*) as attempts, sum(percent) as percent_sum, max(percent) as best_percent
+        from graded
+        group by user_id, category
+    )
+    insert into user_stats (user_id, attempts, percent_sum, best_percent, by_category)
+    select user_id,
+           sum(attempts)::integer,
+           sum(percent_sum)::bigint,
+           max(best_percent)::integer,
+           jsonb_object_agg(category, jsonb_build_object(
+               'attempts', attempts, 'percent_sum', percent_sum, 'best_percent', best_percent))
+    from per_category
+    group by user_id;
+$$;
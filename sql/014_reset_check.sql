@@ -0,0 +1,35 @@
+-- reset_user_progress from 011 decided from user_stats alone; when the
+-- aggregate was missing or behind (a failed record_attempt_stats) it reset
+-- nothing and left every solved task blocked. Now an attempt of the current
+-- epoch or a solved task decides; both are index probes (attempts_user_created_idx
+-- from 011, the solved_tasks key), so a reset stays O(1) in the attempts
+-- history. user_stats only gives the count shown to the user.
+
+-- Returns {"previous_attempts": n}; n = 0 means there was nothing to reset.
+create or replace function reset_user_progress(p_user_id bigint)
+returns json
+language plpgsql
+volatile
+as $$
+declare
+    v_previous integer;
+begin
+    if not exists (select 1
+                   from attempts a
+                   join users u on u.user_id = a.user_id
+                   where a.user_id = p_user_id
+                     -- A range on the index, not a scan of the epochs before the reset.
+                     and a.created_at > coalesce(u.stats_reset_at, '-infinity')
+                   limit 1)
+       and not exists (select 1 from solved_tasks where user_id = p_user_id limit 1) then
+        return json_build_object('previous_attempts', 0);
+    end if;
+
+    select coalesce(max(attempts), 0) into v_previous from user_stats where user_id = p_user_id;
+
+    update users set stats_reset_at = now() where user_id = p_user_id;
+    delete from user_stats where user_id = p_user_id;
+    delete from solved_tasks where user_id = p_user_id;
+    return json_build_object('previous_attempts', greatest(v_previous, 1));
+end;
+$$;
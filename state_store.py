@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Dict
+
+from http_client import supabase_request
+
+# ============= Dialog state (FSM) store =============
+# One row per user in user_states. Writes are a single upsert, expired rows
+# are filtered out by the read query itself, and a bounded LRU keeps the
+# latest state of recently active users for warm containers.
+#
+# The cache is write-through, so it is exact within one process. With
+# several webhook instances another one may change the state in between and
+# a cached entry would be stale (e.g. an answer treated as a category pick),
+# so the cache is off by default (STATE_CACHE_TTL=0); runner.py, where one
+# process serves every update, turns it on.
+STATE_TTL = timedelta(hours=24)
+STATE_CACHE_SIZE = int(os.environ.get('STATE_CACHE_SIZE', '1024'))
+STATE_CACHE_TTL = float(os.environ.get('STATE_CACHE_TTL', '0'))
+
+_cache: "OrderedDict[int, tuple]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _cache_get(user_id: int):
+    # Returns (hit, record); record is None for a known empty state.
+    with _lock:
+        entry = _cache.get(user_id)
+        if entry is None:
+            return False, None
+        expires_at, record = entry
+        if time.monotonic() >= expires_at:
+            del _cache[user_id]
+            return False, None
+        _cache.move_to_end(user_id)
+        return True, record
+
+
+def _cache_put(user_id: int, record: Optional[Dict]):
+    if STATE_CACHE_SIZE <= 0 or STATE_CACHE_TTL <= 0:
+        return
+    with _lock:
+        _cache[user_id] = (time.monotonic() + STATE_CACHE_TTL, record)
+        _cache.move_to_end(user_id)
+        while len(_cache) > STATE_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _cache_drop(user_id: int):
+    with _lock:
+        _cache.pop(user_id, None)
+
+
+def _is_expired(record: Dict) -> bool:
+    updated_at = datetime.fromisoformat(record['updated_at'].replace('Z', '+00:00'))
+    return datetime.utcnow() - updated_at.replace(tzinfo=None) > STATE_TTL
+
+
+def get_state(user_id: int) -> Optional[Dict]:
+    hit, record = _cache_get(user_id)
+    if hit:
+        if record is not None and _is_expired(record):
+            return None
+        return record
+
+    try:
+        cutoff = (datetime.utcnow() - STATE_TTL).isoformat()
+        rows = supabase_request('GET', 'user_states', params={
+            'user_id': f'eq.{user_id}',
+            'updated_at': f'gt.{cutoff}',
+            'select': 'user_id,state,data,updated_at',
+        })
+        if rows is None:
+            return None
+        record = rows[0] if rows else None
+        _cache_put(user_id, record)
+        return record
+
+    except Exception as e:
+        print(f"❌ Ошибка получения состояния: {e}")
+        return None
+
+
+def set_state(user_id: int, state: str, data: Optional[Dict] = None):
+    payload = {
+        'user_id': user_id,
+        'state': state,
+        'data': data or {},
+        'updated_at': datetime.utcnow().isoformat()
+    }
+
+    try:
+        _cache_drop(user_id)
+        result = supabase_request('POST', 'user_states', data=payload,
+                                  params={'on_conflict': 'user_id'},
+                                  prefer='resolution=merge-duplicates,return=minimal')
+        if result is not None:
+            _cache_put(user_id, payload)
+
+    except Exception as e:
+        print(f"❌ Ошибка сохранения состояния: {e}")
+
+
+def clear_state(user_id: int):
+    try:
+        _cache_drop(user_id)
+        result = supabase_request('DELETE', 'user_states', params={'user_id': f'eq.{user_id}', 'select': 'user_id'})
+        if result is not None:
+            _cache_put(user_id, None)
+    except Exception as e:
+        print(f"❌ Ошибка очистки состояния: {e}")
@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Iterable
+
+from http_client import supabase_request
+
+# ============= Task cache =============
+# Tasks change rarely, so warm containers keep recently used rows by id.
+# Entries remember which columns were loaded; a lookup that needs more
+# columns than cached goes to the database again.
+TASK_CACHE_SIZE = int(os.environ.get('TASK_CACHE_SIZE', '512'))
+TASK_CACHE_TTL = float(os.environ.get('TASK_CACHE_TTL', '600'))
+# Column bumped on every change of a task (sql/006_task_versions.sql);
+# an empty value disables revalidation and expired rows are re-downloaded.
+TASK_VERSION_COLUMN = os.environ.get('TASK_VERSION_COLUMN', 'updated_at')
+# Without the migration every select naming the column fails; it is then
+# left out for this long instead of failing every task fetch.
+VERSION_RETRY_SECONDS = 300
+
+# What user_states.data keeps about the issued task.
+STATE_TASK_FIELDS = ('id', 'category', 'max_score')
+
+_cache: "OrderedDict[int, tuple]" = OrderedDict()
+_lock = threading.Lock()
+_version_retry_at = 0.0
+
+
+def compact(task: Dict) -> Dict:
+    """Small projection of a task that is safe to store in the dialog state."""
+    return {k: task.get(k) for k in STATE_TASK_FIELDS}
+
+
+def remember(task: Dict):
+    if TASK_CACHE_SIZE <= 0:
+        return
+    with _lock:
+        entry = _cache.get(task['id'])
+        # Columns are merged only within the same version of the row, so a
+        # partial newer row never gets combined with older columns.
+        column = version_column()
+        version = task.get(column) if column else None
+        if entry and version is not None and entry[1].get(column) == version:
+            row = dict(entry[1], **task)
+        else:
+            row = dict(task)
+        _cache[task['id']] = (time.monotonic() + TASK_CACHE_TTL, row)
+        _cache.move_to_end(task['id'])
+        while len(_cache) > TASK_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _lookup(task_id: int, columns: Iterable[str]):
+    # Returns ('fresh' | 'expired' | 'missing', row).
+    with _lock:
+        entry = _cache.get(task_id)
+        if entry is None or not all(c in entry[1] for c in columns):
+            return 'missing', None
+        expires_at, row = entry
+        if time.monotonic() >= expires_at:
+            return 'expired', row
+        _cache.move_to_end(task_id)
+        return 'fresh', row
+
+
+def _touch(task_id: int):
+    with _lock:
+        entry = _cache.get(task_id)
+        if entry is not None:
+            _cache[task_id] = (time.monotonic() + TASK_CACHE_TTL, entry[1])
+            _cache.move_to_end(task_id)
+
+
+def version_column() -> str:
+    """TASK_VERSION_COLUMN, or '' while it is known to be missing in the database."""
+    return TASK_VERSION_COLUMN if time.monotonic() >= _version_retry_at else ''
+
+
+def _fetch(ids: Iterable[int], columns: str, version: str) -> Optional[list]:
+    global _version_retry_at
+    params = {'id': f"in.({','.join(str(i) for i in sorted(ids))})"}
+    select = columns
+    if version and version not in columns.split(','):
+        select += f',{version}'
+    rows = supabase_request('GET', 'tasks', params=dict(params, select=select))
+    if rows is None and select != columns:
+        # A select without the column that succeeds means the column is missing (no sql/006).
+        rows = supabase_request('GET', 'tasks', params=dict(params, select=columns))
+        if rows is not None:
+            print(f"⚠️ tasks.{version} unavailable, task versions disabled for {VERSION_RETRY_SECONDS}s")
+            _version_retry_at = time.monotonic() + VERSION_RETRY_SECONDS
+    return rows
+
+
+def get_tasks(task_ids: Iterable[int], columns: str = 'id,category,text,max_score') -> Optional[Dict[int, Dict]]:
+    """Returns {task_id: row} for the tasks that exist, None if the database request failed.
+
+    Fresh cache entries are used as is. Expired entries are revalidated by
+    their version column (a small id,updated_at request) and only changed or
+    missing rows are downloaded, all of them in one id=in.(...) request.
+    """
+    wanted = columns.split(',')
+    found: Dict[int, Dict] = {}
+    expired: Dict[int, Dict] = {}
+    missing = []
+    for task_id in set(task_ids):
+        status, row = _lookup(task_id, wanted)
+        if status == 'fresh':
+            found[task_id] = row
+        elif status == 'expired':
+            expired[task_id] = row
+        else:
+            missing.append(task_id)
+
+    version = version_column()
+    if expired and version:
+        versions = supabase_request('GET', 'tasks', params={
+            'id': f"in.({','.join(str(i) for i in expired)})",
+            'select': f'id,{version}',
+        })
+        current = {r['id']: r.get(version) for r in versions or []}
+        for task_id, row in expired.items():
+            if versions is not None and task_id in current and current[task_id] == row.get(version):
+                _touch(task_id)
+                found[task_id] = row
+            else:
+                missing.append(task_id)
+    else:
+        missing.extend(expired)
+
+    if missing:
+        rows = _fetch(missing, columns, version)
+        if rows is None:
+            return None
+        for row in rows:
+            remember(row)
+            found[row['id']] = row
+
+    return found
+
+
+def get_task(task_id: int, columns: str = 'id,category,text,max_score') -> Optional[Dict]:
+    tasks = get_tasks([task_id], columns)
+    return tasks.get(task_id) if tasks else None
+
+
+def invalidate(task_id: Optional[int] = None):
+    with _lock:
+        if task_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(task_id, None)
@@ -0,0 +1,150 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from http_client import telegram_request
+from rate_limit import TokenBucket
+
+# ============= Outbound Telegram messages =============
+# Every Bot API call that sends something goes through send(), which keeps
+# to Telegram's limits: about 30 messages per second per bot and about one
+# per second per chat (short bursts are fine). The buckets live per process,
+# so several function instances may still exceed the global limit together;
+# 429 answers are then handled with retry_after.
+TELEGRAM_GLOBAL_RPS = float(os.environ.get('TELEGRAM_GLOBAL_RPS', '30'))
+TELEGRAM_CHAT_RPS = float(os.environ.get('TELEGRAM_CHAT_RPS', '1'))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', '2'))
+# A 429 asking to wait longer than this is not retried.
+TELEGRAM_MAX_RETRY_AFTER = float(os.environ.get('TELEGRAM_MAX_RETRY_AFTER', '10'))
+CHAT_BUCKETS_SIZE = 4096
+
+# Methods Telegram accepts as the body of a webhook response.
+WEBHOOK_REPLY_METHODS = frozenset({'sendMessage', 'editMessageText'})
+
+_global_bucket = TokenBucket(TELEGRAM_GLOBAL_RPS, TELEGRAM_GLOBAL_RPS)
+_chat_buckets: "OrderedDict[object, TokenBucket]" = OrderedDict()
+_lock = threading.Lock()
+
+
+class RateLimited(Exception):
+    """Sending now would take longer than the caller is willing to wait."""
+
+
+def _chat_bucket(chat_id) -> TokenBucket:
+    with _lock:
+        bucket = _chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = _chat_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RPS, TELEGRAM_CHAT_BURST)
+        _chat_buckets.move_to_end(chat_id)
+        while len(_chat_buckets) > CHAT_BUCKETS_SIZE:
+            _chat_buckets.popitem(last=False)
+        return bucket
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """retry_after of a 429 Bot API answer, None for any other error."""
+    response = getattr(error, 'response', None)
+    if response is None or response.status_code != 429:
+        return None
+    try:
+        return float(response.json()['parameters']['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return 1.0
+
+
+def send(api_method: str, payload: Dict, block: bool = True) -> Dict:
+    """Calls a Bot API method within the rate limits.
+
+    With block=False a call that would have to wait for a token raises
+    RateLimited instead (for updates that may just be skipped). Errors are
+    raised, like telegram_request.
+    """
+    chat = _chat_bucket(payload.get('chat_id'))
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        # Without blocking, both buckets are checked before either token is
+        # taken, so a refused call does not use up the chat's token.
+        if not block and (chat.wait_time() or _global_bucket.wait_time()):
+            raise RateLimited(api_method)
+        chat.acquire()
+        _global_bucket.acquire()
+        try:
+            return telegram_request(api_method, payload)
+        except Exception as e:
+            delay = retry_after_seconds(e)
+            if delay is None or delay > TELEGRAM_MAX_RETRY_AFTER or attempt == TELEGRAM_MAX_RETRIES or not block:
+                raise
+            print(f"⚠️ Telegram rate limit, retrying in {delay:.0f}s")
+            chat.pause(delay)
+
+
+# ============= Outbox =============
+class Outbox:
+    """Messages of one update, sent after its database work is done.
+
+    With exactly one message queued it can instead be returned as the
+    webhook response body, which saves a round trip to Telegram.
+    """
+
+    def __init__(self):
+        self.messages: List[tuple] = []
+        self._after_send: List[Callable] = []
+
+    def add(self, api_method: str, payload: Dict):
+        self.messages.append((api_method, payload))
+
+    def after_send(self, fn: Callable):
+        self._after_send.append(fn)
+
+    def webhook_reply(self) -> Optional[Dict]:
+        """Takes the only queued message as a webhook reply; None if there is not exactly one.
+
+        Also None when after_send callbacks are queued: a webhook reply only
+        leaves once the function returns, so the callbacks would run (and
+        could block, or race the worker's result) before the user sees it.
+        """
+        if (len(self.messages) != 1 or self.messages[0][0] not in WEBHOOK_REPLY_METHODS
+                or self._after_send):
+            return None
+        api_method, payload = self.messages.pop()
+        return dict(payload, method=api_method)
+
+    def flush(self):
+        messages, self.messages = self.messages, []
+        for api_method, payload in messages:
+            try:
+                send(api_method, payload)
+            except Exception as e:
+                print(f"❌ Ошибка отправки сообщения в Telegram: {e}")
+        callbacks, self._after_send = self._after_send, []
+        for fn in callbacks:
+            fn()
+
+
+_current = threading.local()
+
+
+def current() -> Optional[Outbox]:
+    return getattr(_current, 'outbox', None)
+
+
+@contextmanager
+def collect():
+    """Queues the messages sent in this thread into an Outbox instead of sending them."""
+    outbox = Outbox()
+    previous, _current.outbox = current(), outbox
+    try:
+        yield outbox
+    finally:
+        _current.outbox = previous
+
+
+def after_send(fn: Callable):
+    """Runs fn once the queued messages are out (right away when nothing is queued)."""
+    outbox = current()
+    if outbox is None:
+        fn()
+    else:
+        outbox.after_send(fn)
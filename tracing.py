@@ -0,0 +1,163 @@
+import heapq
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, List, Optional, Tuple
+
+# ============= Tracing =============
+# Every call to Supabase, Telegram and Mistral is recorded as a span
+# (backend, operation such as "GET users", duration, error). Spans are not
+# kept: they are added to the counters of the current invocation and to a
+# rolling window of durations per backend, so recording one costs a clock
+# read and a few dict updates under a lock. At the end of an invocation
+# emit() prints one JSON line with the summary.
+#
+# The current invocation is a context variable, so concurrent invocations
+# in one instance keep their own counters; only the rolling windows are
+# shared. Threads start with an empty context: work handed to a thread pool
+# is counted only if it runs in a copy of the caller's context
+# (contextvars.copy_context().run), spans outside any invocation only feed
+# the windows.
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED', '1') == '1'
+# Durations per backend kept for p50/p95; the window outlives invocations in a warm container.
+TRACE_WINDOW = int(os.environ.get('TRACE_WINDOW', '500'))
+# The slowest spans of an invocation listed in the summary.
+TRACE_SLOWEST = int(os.environ.get('TRACE_SLOWEST', '3'))
+# Backends that wait on purpose (long polling): counted, but never listed as slowest.
+WAITING_BACKENDS = frozenset({'telegram_poll'})
+
+_lock = threading.Lock()
+_windows: Dict[str, Deque[float]] = {}
+
+
+class Invocation:
+    """Counters of one invocation; shared by the threads that run in its context."""
+    __slots__ = ('backends', 'slowest', 'started')
+
+    def __init__(self):
+        # backend -> {'calls', 'errors', 'total_ms', 'ops': {operation: [calls, total_ms]}}
+        self.backends: Dict[str, Dict] = {}
+        self.slowest: List[Tuple[float, str]] = []
+        self.started = time.perf_counter()
+
+    def restart(self):
+        """Clears the counters in place (runner.py: the same object, a new window)."""
+        with _lock:
+            self.backends = {}
+            self.slowest = []
+            self.started = time.perf_counter()
+
+
+_current: ContextVar[Optional[Invocation]] = ContextVar('tracing_invocation', default=None)
+
+
+class Span:
+    __slots__ = ('backend', 'operation', 'error')
+
+    def __init__(self, backend: str, operation: str):
+        self.backend = backend
+        self.operation = operation
+        # Set by callers that turn a failure into a return value (supabase_request gives None).
+        self.error = False
+
+
+def record(backend: str, operation: str, duration_ms: float, error: bool = False):
+    invocation = _current.get()
+    with _lock:
+        window = _windows.get(backend)
+        if window is None:
+            window = _windows[backend] = deque(maxlen=TRACE_WINDOW)
+        window.append(duration_ms)
+        if invocation is None:
+            return
+
+        stats = invocation.backends.get(backend)
+        if stats is None:
+            stats = invocation.backends[backend] = {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'ops': {}}
+        stats['calls'] += 1
+        stats['errors'] += int(error)
+        stats['total_ms'] += duration_ms
+        op = stats['ops'].get(operation)
+        if op is None:
+            op = stats['ops'][operation] = [0, 0.0]
+        op[0] += 1
+        op[1] += duration_ms
+
+        entry = (duration_ms, f"{backend} {operation}")
+        slowest = invocation.slowest
+        if backend in WAITING_BACKENDS:
+            return
+        if len(slowest) < TRACE_SLOWEST:
+            heapq.heappush(slowest, entry)
+        elif slowest and entry > slowest[0]:
+            heapq.heapreplace(slowest, entry)
+
+
+@contextmanager
+def span(backend: str, operation: str):
+    """Times the block as one call to `backend`; an exception marks it as failed."""
+    current = Span(backend, operation)
+    if not TRACE_ENABLED:
+        yield current
+        return
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException:
+        current.error = True
+        raise
+    finally:
+        record(backend, operation, (time.perf_counter() - started) * 1000, current.error)
+
+
+def start_invocation() -> Invocation:
+    """Starts new counters for the current context (the rolling windows are kept)."""
+    invocation = Invocation()
+    _current.set(invocation)
+    return invocation
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    # The window is empty with TRACE_WINDOW=0.
+    return None if value is None else round(value, 1)
+
+
+def summary() -> Dict:
+    invocation = _current.get() or Invocation()
+    with _lock:
+        backends = {}
+        for backend, stats in invocation.backends.items():
+            window = list(_windows.get(backend, ()))
+            backends[backend] = {
+                'calls': stats['calls'],
+                'errors': stats['errors'],
+                'total_ms': round(stats['total_ms'], 1),
+                'p50_ms': _round(percentile(window, 0.5)),
+                'p95_ms': _round(percentile(window, 0.95)),
+                'ops': {op: {'calls': n, 'total_ms': round(ms, 1)} for op, (n, ms) in stats['ops'].items()},
+            }
+        return {
+            'duration_ms': round((time.perf_counter() - invocation.started) * 1000, 1),
+            'calls': sum(b['calls'] for b in backends.values()),
+            'backends': backends,
+            'slowest': [{'span': name, 'ms': round(ms, 1)} for ms, name in sorted(invocation.slowest, reverse=True)],
+        }
+
+
+def emit(function: str, **extra) -> Dict:
+    """Prints the summary of the invocation as one JSON line and returns it."""
+    result = {'trace': function, **summary(), **extra}
+    if TRACE_ENABLED:
+        print(json.dumps(result, ensure_ascii=False))
+    return result
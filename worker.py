@@ -1,143 +1,898 @@
 import os
 import json
-import requests
-import time
-import uuid
-import urllib3
+import contextvars
 import re
-from datetime import datetime
-from mistralai import Mistral
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+import grading_cache
+import task_cache
+import telegram_sender
+import tracing
+from rate_limit import TokenBucket, CircuitBreaker
+from http_client import supabase_request as sb_request, supabase_rpc, RpcUnavailable
 
 
 # --- Configuration ---
-TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
-SUPABASE_URL = os.environ.get('SUPABASE_URL')
-SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
 MISTRAL_API_KEY = os.environ.get('MISTRAL_API_KEY') 
 MISTRAL_AGENT_ID = os.environ.get('MISTRAL_AGENT_ID') 
+TASK_COLUMNS = 'id,category,text,answer_key_text,max_score'
 
-# --- Supabase Helpers ---
-def sb_request(method, endpoint, data=None, params=None):
-    url = f"{SUPABASE_URL}/rest/v1/{endpoint}"
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "application/json",
-        "Prefer": "return=representation"
-    }
+# --- Concurrency ---
+# Items are graded in a thread pool. The batch is sized from the remaining
+# function deadline: ITEM_SECONDS is a pessimistic estimate of one item
+# (mostly the LLM call), DEADLINE_RESERVE_SECONDS is kept for the tail.
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '4'))
+MAX_BATCH_SIZE = int(os.environ.get('WORKER_MAX_BATCH_SIZE', '20'))
+ITEM_SECONDS = float(os.environ.get('WORKER_ITEM_SECONDS', '20'))
+DEADLINE_RESERVE_SECONDS = float(os.environ.get('WORKER_DEADLINE_RESERVE_SECONDS', '5'))
+MISTRAL_CONCURRENCY = int(os.environ.get('MISTRAL_CONCURRENCY', '4'))
+# Cheap model that turns a malformed grading reply into the JSON contract.
+MISTRAL_REPAIR_MODEL = os.environ.get('MISTRAL_REPAIR_MODEL', 'mistral-small-latest')
+# Stream single-answer grading: post the score as soon as it is known and
+# edit that message while the comment is written (not used for batches).
+GRADING_STREAM = os.environ.get('GRADING_STREAM', '0') == '1'
+# Telegram allows about one message (or edit) per second in a chat.
+STREAM_EDIT_SECONDS = float(os.environ.get('STREAM_EDIT_SECONDS', '1.5'))
+# Answers packed into one LLM request (1 = one request per answer).
+GRADING_BATCH_SIZE = int(os.environ.get('GRADING_BATCH_SIZE', '1'))
+
+# --- LLM limits ---
+# Requests per second and burst for Mistral, retries on 429, and a circuit
+# breaker that stops calling the LLM after consecutive failures.
+MISTRAL_RPS = float(os.environ.get('MISTRAL_RPS', '2'))
+MISTRAL_BURST = float(os.environ.get('MISTRAL_BURST', '2'))
+MISTRAL_MAX_RETRIES = int(os.environ.get('MISTRAL_MAX_RETRIES', '3'))
+MISTRAL_BACKOFF_SECONDS = float(os.environ.get('MISTRAL_BACKOFF_SECONDS', '2'))
+MISTRAL_TIMEOUT_MS = int(os.environ.get('MISTRAL_TIMEOUT_MS', '60000'))
+MISTRAL_BREAKER_THRESHOLD = int(os.environ.get('MISTRAL_BREAKER_THRESHOLD', '3'))
+MISTRAL_BREAKER_RESET_SECONDS = float(os.environ.get('MISTRAL_BREAKER_RESET_SECONDS', '60'))
+
+_mistral_slots = threading.BoundedSemaphore(MISTRAL_CONCURRENCY)
+_llm_bucket = TokenBucket(MISTRAL_RPS, MISTRAL_BURST)
+_llm_breaker = CircuitBreaker(MISTRAL_BREAKER_THRESHOLD, MISTRAL_BREAKER_RESET_SECONDS)
+
+# Created on first use and reused by warm invocations.
+_mistral_client = None
+_mistral_client_lock = threading.Lock()
+
+# Moving average of one LLM call, used to estimate the time saved by the grading cache.
+_llm_seconds_avg = None
+
+# --- Queue leases ---
+# Claimed items are 'processing' with a lease; an expired lease makes the item
+# claimable again. The owner is unique per invocation.
+WORKER_ID = f"{socket.gethostname()}-{os.urandom(4).hex()}"
+LEASE_SECONDS = int(os.environ.get('WORKER_LEASE_SECONDS', '300'))
+
+class LLMUnavailable(Exception):
+    """The LLM was not called or did not answer; the item has to stay pending."""
+
+
+def get_mistral_client():
+    global _mistral_client
+    if _mistral_client is None:
+        with _mistral_client_lock:
+            if _mistral_client is None:
+                # Imported here: the SDK takes most of the worker's import
+                # time, and idle or cache-only runs never call the LLM.
+                from mistralai import Mistral
+                _mistral_client = Mistral(api_key=MISTRAL_API_KEY, timeout_ms=MISTRAL_TIMEOUT_MS)
+    return _mistral_client
+
+
+def retry_after_seconds(error):
+    headers = getattr(error, 'headers', None) or getattr(getattr(error, 'raw_response', None), 'headers', None) or {}
     try:
-        if method == 'GET':
-            r = requests.get(url, headers=headers, params=params)
-        elif method == 'POST':
-            r = requests.post(url, headers=headers, json=data)
-        elif method == 'PATCH':
-            r = requests.patch(url, headers=headers, json=data, params=params)
-        r.raise_for_status()
-        return r.json()
-    except Exception as e:
-        print(f"Supabase Error ({method} {endpoint}): {e}")
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
         return None
 
-def evaluate_answer(task_text, key_text, user_answer, db_max_score):
 
+def call_llm(fn, *args):
+    """Runs one LLM request under the rate limit, the concurrency limit and the circuit breaker.
+
+    429 answers are retried after Retry-After (or exponential backoff) with
+    the bucket paused for everyone. Any other failure raises LLMUnavailable.
+    """
+    if not _llm_breaker.allow():
+        raise LLMUnavailable("circuit breaker is open")
+    for attempt in range(MISTRAL_MAX_RETRIES + 1):
+        _llm_bucket.acquire()
+        try:
+            with _mistral_slots, tracing.span('mistral', fn.__name__):
+                result = fn(*args)
+        except Exception as e:
+            if getattr(e, 'status_code', None) == 429 and attempt < MISTRAL_MAX_RETRIES:
+                delay = retry_after_seconds(e) or MISTRAL_BACKOFF_SECONDS * 2 ** attempt
+                print(f"⚠️ Mistral rate limit, retrying in {delay:.1f}s")
+                _llm_bucket.pause(delay)
+                continue
+            _llm_breaker.record_failure()
+            raise LLMUnavailable(str(e)) from e
+        if not result:
+            _llm_breaker.record_failure()
+            raise LLMUnavailable("empty response")
+        _llm_breaker.record_success()
+        return result
+
+
+# --- Grade contract ---
+# The agent answers with {"score", "max_score", "comment"}; the score is
+# validated and clamped to the max score from the database.
+GRADE_FORMAT = (
+    'Верни только JSON без пояснений: '
+    '{"score": <балл>, "max_score": <максимальный балл>, "comment": "<комментарий для ученика>"}.'
+)
+
+_JSON_OBJECT = re.compile(r"\{.*\}", re.DOTALL)
+_LEGACY_SCORE = re.compile(r"Баллы\D*(\d+([.,]\d+)?)", re.IGNORECASE)
+
+_parse_stats = {'json': 0, 'repaired': 0, 'legacy': 0, 'failed': 0}
+_parse_stats_lock = threading.Lock()
+
+
+def count_parse(outcome, n=1):
+    with _parse_stats_lock:
+        _parse_stats[outcome] += n
+
+
+def reset_parse_stats():
+    with _parse_stats_lock:
+        for outcome in _parse_stats:
+            _parse_stats[outcome] = 0
+
+
+def validate_grade(entry, db_max_score):
+    """(score, comment) from one decoded JSON object, or None if it breaks the contract."""
+    try:
+        score = float(entry['score'])
+        comment = str(entry.get('comment') or '').strip()
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+    if score != score or not comment:  # NaN
+        return None
+    return min(max(score, 0.0), float(db_max_score)), comment
+
+
+def parse_grade(text, db_max_score):
+    match = _JSON_OBJECT.search(text or "")
+    if not match:
+        return None
+    try:
+        return validate_grade(json.loads(match.group(0)), db_max_score)
+    except ValueError:
+        return None
+
+
+def parse_legacy_grade(text, db_max_score):
+    # Free-text replies of the old prompt: "Баллы: 3", "**Баллы**: 3", "Баллы - 3", "Баллы 3"
+    match = _LEGACY_SCORE.search(text or "")
+    if not match:
+        return None
+    score = float(match.group(1).replace(',', '.'))  # Handle "3,5"
+    return min(max(score, 0.0), float(db_max_score)), text.strip()
+
+
+def repair_reply(raw, db_max_score):
+    """Re-formats a malformed grading reply; does not grade the answer again."""
+    client = get_mistral_client()
+    response = client.chat.complete(
+        model=MISTRAL_REPAIR_MODEL,
+        messages=[{
+            "role": "user",
+            "content": f"Перепиши оценку ниже в формате JSON, не меняя балл и смысл. "
+                       f"Максимальный балл: {db_max_score}. {GRADE_FORMAT}\n\n{raw}",
+        }],
+        response_format={"type": "json_object"},
+    )
+    return response.choices[0].message.content
+
+
+def grade_parsing_summary():
+    """Counts of how LLM replies were parsed; failure_rate is the share that broke the JSON contract."""
+    with _parse_stats_lock:
+        stats = dict(_parse_stats)
+    total = sum(stats.values())
+    stats['failure_rate'] = round((total - stats['json']) / total, 3) if total else 0.0
+    return stats
+
+
+def format_feedback(score, db_max_score, comment):
+    return f"Баллы: {score:g} из {db_max_score:g}\n\n{comment}"
+
+
+def evaluate_answer(task_text, key_text, user_answer, db_max_score, on_delta=None):
+    """Returns the full reply of the agent.
+
+    With on_delta the reply is streamed and on_delta(text_so_far) is called
+    after every received chunk.
+    """
+    client = get_mistral_client()
     
-   
-    client = Mistral(api_key=MISTRAL_API_KEY)
-    
-    prompt=f"Задание: {task_text} Эталонный ответ (для сверки смысла, не слов): {key_text}. Ответ ученика: {user_answer}. Максимальный балл: {db_max_score}"
+    prompt=f"Задание: {task_text} Эталонный ответ (для сверки смысла, не слов): {key_text}. Ответ ученика: {user_answer}. Максимальный балл: {db_max_score}. {GRADE_FORMAT}"
+    if on_delta is None:
+        response = client.beta.conversations.start(
+            agent_id=MISTRAL_AGENT_ID,
+            inputs=prompt,
+        )
+        return response.outputs[0].content
+
+    text = ""
+    with client.beta.conversations.start_stream(agent_id=MISTRAL_AGENT_ID, inputs=prompt) as stream:
+        for event in stream:
+            if event.data.type == "conversation.response.error":
+                raise RuntimeError(event.data.message)
+            if event.data.type == "message.output.delta":
+                content = event.data.content
+                text += content if isinstance(content, str) else getattr(content, 'text', '')
+                on_delta(text)
+    return text
+
+
+# --- Streaming feedback ---
+# A score is taken only once it is followed by "," or "}", so "1" of "10" is not shown early.
+_PARTIAL_SCORE = re.compile(r'"score"\s*:\s*(-?\d+(?:\.\d+)?)\s*[,}]')
+_PARTIAL_COMMENT = re.compile(r'"comment"\s*:\s*"((?:[^"\\]|\\.)*)')
+
+
+def partial_comment(text):
+    """The part of the JSON comment string received so far, unescaped."""
+    match = _PARTIAL_COMMENT.search(text)
+    if not match:
+        return ""
+    raw = match.group(1)
+    # The chunk may end inside an escape sequence such as \u04
+    for cut in range(0, 6):
+        try:
+            return json.loads(f'"{raw[:len(raw) - cut]}"')
+        except ValueError:
+            continue
+    return raw
+
+
+class LiveFeedback:
+    """One Telegram message that shows the grade while the LLM is still writing it."""
+
+    def __init__(self, chat_id, db_max_score):
+        self.chat_id = chat_id
+        self.db_max_score = db_max_score
+        self.message_id = None
+        self._text = None
+        self._edited_at = 0.0
+
+    def update(self, reply_so_far):
+        match = _PARTIAL_SCORE.search(reply_so_far)
+        if not match:
+            return
+        score = min(max(float(match.group(1)), 0.0), float(self.db_max_score))
+        text = f"⏳ Баллы: {score:g} из {self.db_max_score:g}\n\n{partial_comment(reply_so_far)}".rstrip()
+        if self.message_id is None:
+            # Plain text: an unfinished comment may contain unbalanced Markdown.
+            try:
+                sent = telegram_sender.send('sendMessage', {"chat_id": self.chat_id, "text": text})
+                self.message_id = sent['result']['message_id']
+            except Exception as e:
+                print(f"Telegram Error: {e}")
+                return
+        elif text == self._text or time.monotonic() - self._edited_at < STREAM_EDIT_SECONDS:
+            return
+        elif not self._edit({"text": text}, block=False):
+            return
+        self._text = text
+        self._edited_at = time.monotonic()
+
+    def finish(self, text):
+        """Replaces the live message with the final text; False if there is no live message."""
+        if self.message_id is None:
+            return False
+        return self._edit({"text": text, "parse_mode": "Markdown"})
+
+    def _edit(self, payload, block=True):
+        try:
+            telegram_sender.send('editMessageText', dict(payload, chat_id=self.chat_id, message_id=self.message_id),
+                                 block=block)
+            return True
+        except telegram_sender.RateLimited:
+            # An intermediate edit can be skipped, the next one carries the text.
+            return False
+        except Exception as e:
+            print(f"Telegram Error: {e}")
+            return False
+
+
+# --- Batch grading ---
+BATCH_PROMPT_HEADER = (
+    "Оцени ответы учеников на несколько заданий. Каждый ответ оценивай независимо от остальных. "
+    "Верни только JSON-массив без пояснений, по одному объекту на каждый номер: "
+    '[{"id": <номер>, "score": <балл>, "comment": "<комментарий>"}]. '
+    "Балл не может превышать максимальный балл задания."
+)
+
+_JSON_ARRAY = re.compile(r"\[.*\]", re.DOTALL)
+
+
+def build_batch_prompt(entries):
+    """entries: list of (task, user_answer); items are numbered from 0."""
+    blocks = [BATCH_PROMPT_HEADER]
+    for number, (task, user_answer) in enumerate(entries):
+        blocks.append(
+            f"### Номер {number}\n"
+            f"Задание: {task['text']}\n"
+            f"Эталонный ответ (для сверки смысла, не слов): {task['answer_key_text']}\n"
+            f"Ответ ученика: {user_answer}\n"
+            f"Максимальный балл: {task.get('max_score', 2)}"
+        )
+    return "\n\n".join(blocks)
+
+
+def evaluate_answers_batch(entries):
+    client = get_mistral_client()
     response = client.beta.conversations.start(
         agent_id=MISTRAL_AGENT_ID,
-        inputs=prompt,
+        inputs=build_batch_prompt(entries),
     )
-
     return response.outputs[0].content
 
 
+def parse_batch_grades(text, max_scores):
+    """Per-item (score, comment, raw) from a batch reply, keyed by item number.
+
+    raw is the item's own array element as JSON, stored with its attempt
+    instead of the whole reply (which holds other students' grades).
+
+    Items that are missing, duplicated or malformed are left out, so the
+    caller can grade just those one by one. Scores are clamped to [0, max].
+    """
+    match = _JSON_ARRAY.search(text or "")
+    if not match:
+        return {}
+    try:
+        data = json.loads(match.group(0))
+    except ValueError:
+        return {}
+    grades = {}
+    for entry in data if isinstance(data, list) else []:
+        try:
+            number = int(entry['id'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if number not in max_scores or number in grades:
+            continue
+        grade = validate_grade(entry, max_scores[number])
+        if grade:
+            grades[number] = (*grade, json.dumps(entry, ensure_ascii=False))
+    return grades
+
+
 # --- Telegram Helper ---
 def send_telegram_message(chat_id, text):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     try:
-        requests.post(url, json={"chat_id": chat_id, "text": text, "parse_mode": "Markdown"})
+        telegram_sender.send('sendMessage', {"chat_id": chat_id, "text": text, "parse_mode": "Markdown"})
     except Exception as e:
         print(f"Telegram Error: {e}")
 
+# --- Batch sizing ---
+def batch_size_for(context) -> int:
+    """How many queue items fit into the remaining function deadline."""
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining is None:
+        return MAX_BATCH_SIZE
+    seconds_left = get_remaining() / 1000 - DEADLINE_RESERVE_SECONDS
+    waves = int(seconds_left // ITEM_SECONDS)
+    return max(0, min(MAX_BATCH_SIZE, waves * WORKER_CONCURRENCY))
+
+
+def lease_seconds_for(context) -> int:
+    # The function cannot outlive its deadline, so the lease only has to cover it.
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining is None:
+        return LEASE_SECONDS
+    return int(get_remaining() / 1000) + 30
+
+
+# --- Queue claiming ---
+def utc_now(offset_seconds: float = 0) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=offset_seconds)).isoformat()
+
+
+def event_queue_ids(event):
+    """Queue ids of a wake-up event, or None for a timer (sweeper) run.
+
+    Accepts a direct invocation payload {"queue_ids": [...]}, the same
+    payload as an HTTP body, or message-queue trigger messages carrying it.
+    """
+    if not isinstance(event, dict):
+        return None
+    payloads = [event]
+    if isinstance(event.get('body'), str):
+        try:
+            payloads.append(json.loads(event['body']))
+        except ValueError:
+            pass
+    for message in event.get('messages') or []:
+        try:
+            payloads.append(json.loads(message['details']['message']['body']))
+        except (KeyError, TypeError, ValueError):
+            pass
+    ids = [int(i) for p in payloads if isinstance(p, dict) for i in p.get('queue_ids') or []]
+    return sorted(set(ids)) or None
+
+
+def claim_items(owner, limit, lease_seconds, queue_ids=None):
+    """Atomically moves up to `limit` claimable items to 'processing' for `owner`.
+
+    With queue_ids only those items are considered (wake-up runs).
+    """
+    args = {'p_owner': owner, 'p_limit': limit, 'p_lease_seconds': lease_seconds}
+    if queue_ids:
+        args['p_ids'] = queue_ids
+    try:
+        items = supabase_rpc('claim_queue_items', args)
+        return items or []
+    except RpcUnavailable:
+        print("⚠️ claim_queue_items RPC unavailable, claiming row by row")
+
+    # Fallback: conditional PATCH per candidate; only one worker's PATCH matches.
+    claimable = f"(status.eq.pending,and(status.eq.processing,lease_expires_at.lt.\"{utc_now()}\"))"
+    params = {
+        "select": "id",
+        "or": claimable,
+        "limit": str(limit),
+        "order": "created_at.asc"
+    }
+    if queue_ids:
+        params["id"] = f"in.({','.join(str(i) for i in queue_ids)})"
+    candidates = sb_request('GET', 'processing_queue', params=params) or []
+    claimed = []
+    for candidate in candidates:
+        rows = sb_request('PATCH', 'processing_queue',
+                          data={"status": "processing", "lease_owner": owner,
+                                "lease_expires_at": utc_now(lease_seconds)},
+                          params={"id": f"eq.{candidate['id']}", "or": claimable})
+        if rows:
+            claimed.append(rows[0])
+    return claimed
+
+
+def update_claimed(queue_ids, owner, data):
+    # One PATCH for all ids. Guarded by the lease owner, so a worker whose
+    # lease was taken over cannot overwrite the new owner's result.
+    if not queue_ids:
+        return []
+    return sb_request('PATCH', 'processing_queue', data=data, params={
+        "id": f"in.({','.join(str(i) for i in queue_ids)})",
+        "lease_owner": f"eq.{owner}",
+        "select": "id",
+    })
+
+
+def release_items(queue_ids, owner):
+    """Returns items to the queue for a later run."""
+    return update_claimed(queue_ids, owner, {"status": "pending", "lease_owner": None, "lease_expires_at": None})
+
+
+# --- Item processing ---
+def timed_evaluate(task, user_answer, live=None):
+    global _llm_seconds_avg
+    started = time.perf_counter()
+    args = (task['text'], task['answer_key_text'], user_answer, task.get('max_score', 2))
+    if live:
+        result = call_llm(evaluate_answer, *args, live.update)
+    else:
+        result = call_llm(evaluate_answer, *args)
+    elapsed = time.perf_counter() - started
+    _llm_seconds_avg = elapsed if _llm_seconds_avg is None else 0.8 * _llm_seconds_avg + 0.2 * elapsed
+    return result
+
+
+def pre_grade(item, tasks, cached_grades):
+    """Result for items that need no LLM call (unknown task, cached grade), else None."""
+    queue_id = item['id']
+    task_id = item['task_id']
+    
+    print(f"Processing queue_id {queue_id}...")
+    
+    # 2. Task Details (Question & Key), fetched for the whole batch
+    task = tasks.get(task_id)
+    if not task:
+        print(f"Task {task_id} not found!")
+        return {'item': item, 'status': 'error', 'error_message': 'Task not found'}
+        
+    key = grading_cache.cache_key(task, item['user_answer_text'])
+    cached = cached_grades.get(key)
+    if cached:
+        print(f"Grading cache hit for queue_id {queue_id}.")
+        return graded_result(item, key, cached['score'], task.get('max_score', 2),
+                             cached['comment'], cached['comment'], cached=True)
+    return None
+
+
+def grade_with_llm(item, task):
+    """Grades one item; every result carries 'live', so a streamed message is always finished."""
+    live = LiveFeedback(item['chat_id'], task.get('max_score', 2)) if GRADING_STREAM else None
+    try:
+        result = grade_reply(item, task, live)
+    except Exception as e:
+        print(f"❌ Error processing queue_id {item['id']}: {e}")
+        result = {'item': item, 'status': 'skipped'}
+    result['live'] = live
+    return result
+
+
+def grade_reply(item, task, live):
+    queue_id = item['id']
+    user_answer = item['user_answer_text']
+    db_max_score = task.get('max_score', 2)
+    key = grading_cache.cache_key(task, user_answer)
+    
+    # 3. Call LLM
+    try:
+        llm_result = timed_evaluate(task, user_answer, live)
+    except LLMUnavailable as e:
+        print(f"LLM failed, queue_id {queue_id} stays pending: {e}")
+        return {'item': item, 'status': 'skipped'}
+
+    # 4. Parse the grade: JSON contract, the old free-text format (free), then one paid repair pass
+    grade = parse_grade(llm_result, db_max_score)
+    outcome = 'json'
+    if grade is None:
+        outcome = 'legacy'
+        grade = parse_legacy_grade(llm_result, db_max_score)
+    if grade is None:
+        outcome = 'repaired'
+        try:
+            grade = parse_grade(call_llm(repair_reply, llm_result, db_max_score), db_max_score)
+        except LLMUnavailable as e:
+            print(f"Repair pass failed for queue_id {queue_id}: {e}")
+    if grade is None:
+        count_parse('failed')
+        print(f"⚠️ Warning: Could not parse score from: {llm_result}")
+        return {'item': item, 'status': 'error', 'error_message': 'Unparseable grade'}
+    count_parse(outcome)
+
+    score, comment = grade
+    return graded_result(item, key, score, db_max_score, comment, llm_result, cached=False)
+
+
+def grade_with_llm_batch(items, tasks):
+    """Grades several items with one LLM request; returns {queue_id: result} for the parsed ones."""
+    entries = [(tasks[item['task_id']], item['user_answer_text']) for item in items]
+    try:
+        reply = call_llm(evaluate_answers_batch, entries)
+    except LLMUnavailable as e:
+        print(f"Batch LLM call failed: {e}")
+        return {}
+    grades = parse_batch_grades(reply, {n: task.get('max_score', 2) for n, (task, _) in enumerate(entries)})
+    count_parse('json', len(grades))
+    if len(grades) < len(items):
+        print(f"⚠️ Batch reply covered {len(grades)} of {len(items)} answers, grading the rest one by one")
+    results = {}
+    for number, (score, comment, raw) in grades.items():
+        item = items[number]
+        task, user_answer = entries[number]
+        results[item['id']] = graded_result(item, grading_cache.cache_key(task, user_answer),
+                                            score, task.get('max_score', 2), comment, raw, cached=False)
+    return results
+
+
+def grade_chunk(chunk, tasks, cached_grades):
+    """Grades a chunk of claimed items without writing anything.
+
+    Returns one result dict per item with 'status' ('graded', 'error' or
+    'skipped'); graded results carry the attempt row and the notification
+    text. Items that need the LLM share one batch request when there are
+    several of them; whatever the batch reply does not cover is graded
+    one by one.
+    """
+    results = {}
+    llm_items = []
+    for item in chunk:
+        result = pre_grade(item, tasks, cached_grades)
+        if result:
+            results[item['id']] = result
+        else:
+            llm_items.append(item)
+
+    if len(llm_items) > 1:
+        results.update(grade_with_llm_batch(llm_items, tasks))
+    for item in llm_items:
+        if item['id'] not in results:
+            results[item['id']] = grade_with_llm(item, tasks[item['task_id']])
+    return [results[item['id']] for item in chunk]
+
+
+def graded_result(item, key, score, db_max_score, comment, llm_result, cached):
+    attempt_data = {
+        "queue_id": item['id'],  # idempotency key, sql/013_attempt_idempotency.sql
+        "user_id": item['user_id'],
+        "task_id": item['task_id'],
+        "user_answer_text": item['user_answer_text'],
+        "chat_response": {"raw": llm_result, "cached": cached},
+        "score": score,       # Parsed from LLM, clamped to max_score
+        "max_score": db_max_score, # From our Database
+        "comment": comment
+    }
+    return {
+        'item': item,
+        'status': 'graded',
+        'attempt': attempt_data,
+        'cache_key': key,
+        'cached': cached,
+        'message': f"✅ *Проверка завершена!*\n\n{format_feedback(score, db_max_score, comment)}",
+    }
+
+
+def stored_results(items):
+    """Results of claimed items whose attempt is already stored, {queue_id: result}; None if unknown.
+
+    Such an item was graded by a worker that lost its lease (or whose
+    'processed' PATCH failed) after storing the attempt. It is marked
+    processed and notified with the stored grade, not graded again.
+    """
+    rows = sb_request('GET', 'attempts', params={
+        "select": "queue_id,score,max_score,comment",
+        "queue_id": f"in.({','.join(str(item['id']) for item in items)})",
+    })
+    if rows is None:
+        return None
+    by_id = {item['id']: item for item in items}
+    results = {}
+    for row in rows:
+        item = by_id[row['queue_id']]
+        result = graded_result(item, None, row['score'], row['max_score'], row['comment'], None, cached=False)
+        result['stored'] = True
+        results[item['id']] = result
+    return results
+
+
+def safe_grade_chunk(chunk, tasks, cached_grades):
+    try:
+        return grade_chunk(chunk, tasks, cached_grades)
+    except Exception as e:
+        print(f"❌ Error processing queue_ids {[item.get('id') for item in chunk]}: {e}")
+        return [{'item': item, 'status': 'skipped'} for item in chunk]
+
+
+# --- Bulk writes ---
+ATTEMPT_UPSERT = {'params': {'on_conflict': 'queue_id'}, 'prefer': 'resolution=ignore-duplicates,return=minimal'}
+
+
+def insert_attempts(graded):
+    """Inserts attempts of graded results; returns the results that persisted.
+
+    The bulk insert is one statement, so it either stores every row or none.
+    On failure the rows are retried one by one to find out which persist.
+    Attempts are unique per queue_id, so a row that is already stored (the
+    bulk insert committed but its response was lost, or the item was
+    re-claimed) is skipped instead of stored twice.
+    """
+    if not graded:
+        return []
+    rows = sb_request('POST', 'attempts', data=[r['attempt'] for r in graded], **ATTEMPT_UPSERT)
+    if rows is not None:
+        return graded
+    if len(graded) == 1:
+        return []
+    print("⚠️ Bulk attempts insert failed, retrying row by row")
+    return [r for r in graded
+            if sb_request('POST', 'attempts', data=r['attempt'], **ATTEMPT_UPSERT) is not None]
+
+
+def flush_results(results, owner):
+    """Persists a graded batch: attempts first, then the queue statuses.
+
+    Returns the results whose attempt is stored and whose queue item is
+    marked processed by this owner. Items without a stored attempt go back
+    to 'pending'; a stored one that could not be marked (the lease was taken
+    over, the PATCH failed) is left to whoever claims it next, which finds
+    the attempt and notifies instead of grading again.
+    """
+    graded = [r for r in results if r['status'] == 'graded']
+    stored = insert_attempts([r for r in graded if not r.get('stored')]) + [r for r in graded if r.get('stored')]
+    stored_ids = {r['item']['id'] for r in stored}
+
+    # 5. Queue statuses: processed / back to pending (errors: flush_errors)
+    rows = update_claimed(sorted(stored_ids), owner,
+                          {"status": "processed", "processed_at": datetime.utcnow().isoformat(),
+                           "lease_expires_at": None})
+    processed_ids = {row['id'] for row in rows or []}
+    if len(processed_ids) < len(stored_ids):
+        print(f"⚠️ {len(stored_ids) - len(processed_ids)} stored items not marked processed, lease lost")
+    retry_ids = [r['item']['id'] for r in results
+                 if r['status'] != 'error' and r['item']['id'] not in stored_ids]
+    if retry_ids:
+        print(f"Returning {len(retry_ids)} items to the queue.")
+        release_items(retry_ids, owner)
+    return [r for r in stored if r['item']['id'] in processed_ids]
+
+
+RETRY_MESSAGE = "⏳ *Проверка будет повторена.*\n\nПромежуточная оценка не сохранилась, результат придёт отдельным сообщением."
+FAILED_MESSAGE = "⚠️ *Не удалось проверить ответ.*\n\nПопробуй отправить его ещё раз позже."
+REFUNDED_MESSAGE = "⚠️ *Не удалось проверить ответ.*\n\nПопытка возвращена на баланс, попробуй отправить ответ ещё раз."
+
+
+def refund_attempts(queue_ids):
+    """Gives back the attempts of items marked 'error' (sql/012_refund_attempts.sql); True if refunded."""
+    if not queue_ids:
+        return False
+    try:
+        refunded = supabase_rpc('refund_attempts', {'p_queue_ids': queue_ids})
+    except RpcUnavailable:
+        print("⚠️ refund_attempts RPC unavailable, attempts not refunded")
+        return False
+    return bool(refunded)
+
+
+def flush_errors(results, owner):
+    """Marks items that cannot be graded as 'error' and refunds their attempts.
+
+    Returns the error results whose status was stored, each with the
+    message for the user; the others come back when their lease expires.
+    """
+    by_message = {}
+    for r in results:
+        if r['status'] == 'error':
+            by_message.setdefault(r['error_message'], []).append(r['item']['id'])
+    stored = set()
+    for message, ids in by_message.items():
+        rows = update_claimed(ids, owner, {"status": "error", "error_message": message, "lease_expires_at": None})
+        stored.update(row['id'] for row in rows or [])
+    failed = [r for r in results if r['status'] == 'error' and r['item']['id'] in stored]
+    message = REFUNDED_MESSAGE if refund_attempts(sorted(stored)) else FAILED_MESSAGE
+    for r in failed:
+        r['message'] = message
+    return failed
+
+
+def record_stats(persisted, tasks):
+    """Adds the stored attempts to the user_stats aggregate in one RPC (sql/009_user_stats.sql)."""
+    rows = []
+    for r in persisted:
+        attempt = r['attempt']
+        max_score = float(attempt['max_score'] or 0)
+        rows.append({
+            'queue_id': attempt['queue_id'],  # counted once even if this is called again
+            'user_id': attempt['user_id'],
+            'category': tasks.get(attempt['task_id'], {}).get('category'),
+            'percent': round(float(attempt['score']) / max_score * 100) if max_score > 0 else 0,
+        })
+    if not rows:
+        return
+    try:
+        if supabase_rpc('record_attempt_stats', {'p_rows': rows}) is None:
+            print("⚠️ user_stats not updated, run rebuild_user_stats() to catch up")
+    except RpcUnavailable:
+        print("⚠️ record_attempt_stats RPC unavailable, user_stats not updated")
+
+
+def is_solved(attempt):
+    # Same threshold as pick_random_task always used: max score up to rounding.
+    max_score = float(attempt['max_score'] or 0)
+    return max_score > 0 and float(attempt['score']) >= max_score - 0.1
+
+
+def mark_solved(persisted):
+    """Adds tasks solved on max score to solved_tasks (one upsert, sql/010_solved_tasks.sql)."""
+    rows = {(r['attempt']['user_id'], r['attempt']['task_id']) for r in persisted if is_solved(r['attempt'])}
+    if rows:
+        sb_request('POST', 'solved_tasks', data=[{'user_id': u, 'task_id': t} for u, t in sorted(rows)],
+                   params={'on_conflict': 'user_id,task_id'},
+                   prefer='resolution=ignore-duplicates,return=minimal')
+
+
+def notify(result):
+    live = result.get('live')
+    if live is None or not live.finish(result['message']):
+        send_telegram_message(result['item']['chat_id'], result['message'])
+
+
+def run_parallel(fn, items):
+    if WORKER_CONCURRENCY > 1 and len(items) > 1:
+        with ThreadPoolExecutor(max_workers=min(WORKER_CONCURRENCY, len(items))) as pool:
+            # A copy of the context per item keeps the spans in this invocation's trace.
+            futures = [pool.submit(contextvars.copy_context().run, fn, item) for item in items]
+            return [future.result() for future in futures]
+    return [fn(item) for item in items]
+
+
 # --- MAIN HANDLER ---
 def handler(event, context):
+    tracing.start_invocation()
+    try:
+        return process_queue(event, context)
+    finally:
+        tracing.emit('worker')
+
+
+def process_queue(event, context):
     print("Worker started...")
+    reset_parse_stats()
     
-    # 1. Fetch pending tasks (LIMIT 5 to avoid timeouts per execution)
-    pending_items = sb_request('GET', 'processing_queue', params={
-        "select": "*",
-        "status": "eq.pending",
-        "limit": "5",
-        "order": "created_at.asc"
-    })
+    batch_size = batch_size_for(context)
+    if batch_size <= 0:
+        print("Not enough time left for an LLM call.")
+        return {"statusCode": 200, "body": "Idle"}
+    
+    # 1. Claim pending tasks (sized to the remaining deadline); a wake-up
+    #    event only claims its own ids, timer runs sweep the whole queue
+    owner = f"{WORKER_ID}-{os.urandom(4).hex()}"
+    queue_ids = event_queue_ids(event)
+    if queue_ids:
+        batch_size = min(batch_size, len(queue_ids))
+    pending_items = claim_items(owner, batch_size, lease_seconds_for(context), queue_ids)
     
     if not pending_items:
         print("No pending tasks found.")
         return {"statusCode": 200, "body": "Idle"}
     
-    print(f"Found {len(pending_items)} tasks.")
-
-    for item in pending_items:
-        queue_id = item['id']
-        user_id = item['user_id']
-        chat_id = item['chat_id']
-        task_id = item['task_id']
-        user_answer = item['user_answer_text']
-        
-        print(f"Processing queue_id {queue_id}...")
-        
-        # 2. Get Task Details (Question & Key)
-        tasks = sb_request('GET', 'tasks', params={"id": f"eq.{task_id}"})
-        if not tasks:
-            print(f"Task {task_id} not found!")
-            sb_request('PATCH', 'processing_queue', data={"status": "error", "error_message": "Task not found"}, params={"id": f"eq.{queue_id}"})
-            continue
-            
-        task = tasks[0]
-        db_max_score = task.get('max_score', 2)
-        
-        # 3. Call LLM
-        llm_result = evaluate_answer(task['text'], task['answer_key_text'], user_answer, db_max_score)
-        
-        if not llm_result:
-            # Maybe we should retry later? or mark error
-            print("LLM failed.")
-            continue
+    print(f"Claimed {len(pending_items)} tasks as {owner}.")
 
-        # 4. Parse Score 
-        # Matches: "Баллы: 3", "**Баллы**: 3", "Баллы - 3", "Баллы 3"
-        score_match = re.search(r"Баллы\D*(\d+([.,]\d+)?)", llm_result, re.IGNORECASE)
-        
-        if score_match:
-            score_str = score_match.group(1).replace(',', '.') # Handle "3,5"
-            score = float(score_str)
-        else:
-            print(f"⚠️ Warning: Could not parse score from: {llm_result}") 
-            score = 0.0
-        
-        # 5. Save to Attempts Table
-        attempt_data = {
-            "user_id": user_id,
-            "task_id": task_id,
-            "user_answer_text": user_answer,
-            "chat_response": {"raw": llm_result},
-            "score": score,       # Parsed from LLM
-            "max_score": db_max_score, # From our Database
-            "comment": llm_result
-        }
-        sb_request('POST', 'attempts', data=attempt_data)
-        
-        # 6. Update Queue Status
-        sb_request('PATCH', 'processing_queue', 
-                   data={"status": "processed", "processed_at": datetime.utcnow().isoformat()}, 
-                   params={"id": f"eq.{queue_id}"})
-        
-        result_text = f"✅ *Проверка завершена!*\n\n{llm_result}"
-        send_telegram_message(chat_id, result_text)
+    # 2. Items graded before whose attempt is already stored (a lost lease) are not graded again
+    stored = stored_results(pending_items)
+    if stored is None:
+        print("Could not check stored attempts, returning the batch to the queue.")
+        release_items([item['id'] for item in pending_items], owner)
+        return {"statusCode": 200, "body": "Attempts unavailable"}
+    to_grade = [item for item in pending_items if item['id'] not in stored]
+
+    # One request for all distinct tasks of the batch (cached ones are skipped)
+    tasks = task_cache.get_tasks({item['task_id'] for item in pending_items}, columns=TASK_COLUMNS)
+    if tasks is None:
+        print("Could not load tasks, returning the batch to the queue.")
+        release_items([item['id'] for item in pending_items], owner)
+        return {"statusCode": 200, "body": "Tasks unavailable"}
+
+    # 3. Grades of identical earlier answers (local LRU, then one request)
+    keys = [grading_cache.cache_key(tasks[item['task_id']], item['user_answer_text'])
+            for item in to_grade if item['task_id'] in tasks]
+    cached_grades = grading_cache.lookup_many(keys)
+
+    # 4. Grade the rest in parallel (GRADING_BATCH_SIZE answers per LLM request), buffering the results
+    size = max(1, GRADING_BATCH_SIZE)
+    chunks = [to_grade[i:i + size] for i in range(0, len(to_grade), size)]
+    graded_chunks = run_parallel(partial(safe_grade_chunk, tasks=tasks, cached_grades=cached_grades), chunks)
+    results = list(stored.values()) + [result for chunk in graded_chunks for result in chunk]
+
+    # 5. Bulk writes
+    persisted = flush_results(results, owner)
+    failed = flush_errors(results, owner)
+    grading_cache.store_many({
+        r['cache_key']: {'score': r['attempt']['score'], 'max_score': r['attempt']['max_score'],
+                         'comment': r['attempt']['comment']}
+        for r in persisted if not r['cached'] and not r.get('stored')
+    })
+
+    record_stats(persisted, tasks)
+    mark_solved(persisted)
+
+    # 6. Notify only about results that were stored (grades and failures); streamed ones get their live
+    #    message edited, and a live message of an item graded again later says so
+    run_parallel(notify, persisted + failed)
+    notified_ids = {r['item']['id'] for r in persisted + failed}
+    for r in results:
+        if r.get('live') and r['item']['id'] not in notified_ids:
+            r['live'].finish(RETRY_MESSAGE)
         
+    hits = sum(1 for r in results if r.get('cached'))
     return {
         "statusCode": 200,
-        "body": f"Processed {len(pending_items)} tasks"
+        "body": json.dumps({
+            "processed": len(persisted),
+            "failed": len(failed),
+            "claimed": len(pending_items),
+            "grading_cache": {
+                "lookups": len(keys),
+                "hits": hits,
+                "hit_rate": round(hits / len(keys), 3) if keys else 0.0,
+                # No LLM call measured yet in this container: use the estimate.
+                "saved_seconds": round(hits * (_llm_seconds_avg or ITEM_SECONDS), 2),
+            },
+            "grade_parsing": grade_parsing_summary(),
+            "llm_circuit_open": _llm_breaker.is_open,
+        })
     }